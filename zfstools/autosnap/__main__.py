@@ -2,15 +2,23 @@
 
 from __future__ import print_function
 
+from concurrent import futures
 import argparse
+import collections
 import datetime
+import io
 import os
 import re
+import shlex
 import subprocess
 import sys
+import threading
 import time
 
-from .schedule import label_snapshots, parse_datetime
+from . import listing
+from .listing import list_datasets, parse_snapshot
+from .schedule import label_snapshots
+from ..utils import format_bytes
 
 
 IGNORE_NAMES = set('''
@@ -18,6 +26,205 @@ IGNORE_NAMES = set('''
 '''.strip().split())
 
 
+def iter_batches(names, max_bytes):
+    """Group names by pool, and then into batches with at most so many bytes.
+
+    Operations on many snapshots at once (e.g. `zfs snapshot a@x b@x`) must
+    all be within one pool, and the command line can only be so long.
+
+    """
+
+    by_pool = {}
+    for name in names:
+        by_pool.setdefault(name.split('/', 1)[0].split('@', 1)[0], []).append(name)
+
+    for pool_names in by_pool.values():
+        batch = []
+        size = 0
+        for name in pool_names:
+            if batch and size + len(name) + 1 > max_bytes:
+                yield batch
+                batch = []
+                size = 0
+            batch.append(name)
+            size += len(name) + 1
+        if batch:
+            yield batch
+
+
+def iter_destroy_args(volume, snapshots, order, max_bytes):
+    """Build arguments for `zfs destroy` which cover the given snapshots.
+
+    Runs of snapshots (by createtxg, which is what zfs uses for ranges) are
+    given as ``first%last``, but only if everything between is also given.
+    Each argument is at most about so many bytes.
+
+    """
+
+    doomed = set(snapshots)
+
+    specs = []
+    run = []
+    for name in order + [None]:
+        if name in doomed:
+            run.append(name.split('@', 1)[1])
+            continue
+        if len(run) > 2:
+            specs.append('{}%{}'.format(run[0], run[-1]))
+        else:
+            specs.extend(run)
+        run = []
+
+    # Anything we don't know the order of.
+    specs.extend(name.split('@', 1)[1] for name in snapshots if name not in order)
+
+    arg = None
+    for spec in specs:
+        if arg and len(arg) + len(spec) + 1 > max_bytes:
+            yield arg
+            arg = None
+        arg = '{},{}'.format(arg, spec) if arg else '{}@{}'.format(volume, spec)
+    if arg:
+        yield arg
+
+
+def get_written_between(dataset, snapshot, next_snapshot, order_index):
+    """How much was written after one snapshot, up to and including another.
+
+    :returns: Bytes, or None if we don't know.
+
+    """
+
+    start = order_index.get(snapshot)
+    end = order_index.get(next_snapshot)
+    if start is None or end is None or start >= end:
+        return
+
+    total = 0
+    for name in dataset.order[start + 1:end + 1]:
+        written = dataset.written.get(name)
+        if written is None:
+            return
+        total += written
+    return total
+
+
+def is_diff_empty(snapshot, next_snapshot, verbose=0, log=print):
+    """If `zfs diff` has nothing (that we care about) between two snapshots."""
+
+    cmd = listing.ZFS_CMD + ['diff', '-FH', snapshot, next_snapshot]
+    if verbose:
+        log('    $', ' '.join(cmd))
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+    empty = True
+    for line in proc.stdout:
+
+        line = line.strip().decode()
+        if not line:
+            continue
+
+        line_parts = line.split('\t')
+        op = line_parts[0]
+        type_ = line_parts[1]
+        path = line_parts[2]
+
+        # Don't care about metadata on directories.
+        if op == 'M' and type_ == '/':
+            continue
+
+        # Don't care about a few little files.
+        name = os.path.basename(path)
+        if name in IGNORE_NAMES:
+            continue
+
+        if verbose:
+            log('      Found change:', path)
+        empty = False
+        break
+
+    # We don't need the rest of it.
+    proc.kill()
+    proc.wait()
+
+    return empty
+
+
+def run_per_dataset(func, items, jobs=4, per_pool=2):
+    """Call ``func(volume, *args, log=log)`` for each of ``(volume, args)``.
+
+    They run in parallel, but with only so many at once on any one pool.
+    Whatever they log is held until they are done, and printed in order.
+
+    :returns: The combined return code.
+
+    """
+
+    # Each pool has its own queue, and only gets so many handed to the
+    # executor at once; if the workers waited on the pools instead they would
+    # all end up waiting on the first (since zfs lists them by pool).
+    queues = collections.OrderedDict()
+    for i, (volume, _) in enumerate(items):
+        queues.setdefault(volume.split('/', 1)[0], collections.deque()).append(i)
+    running = collections.Counter()
+
+    def run(volume, args):
+        out = io.StringIO()
+        def log(*args):
+            print(*args, file=out)
+        try:
+            code = func(volume, *args, log=log)
+        except subprocess.CalledProcessError as e:
+            log('ERROR: Non-zero return code {} from: {}'.format(e.returncode, ' '.join(e.cmd)))
+            code = e.returncode
+        return out.getvalue(), code
+
+    code = 0
+    fs = {}
+    pending = {}
+    next_i = 0
+
+    with futures.ThreadPoolExecutor(jobs) as executor:
+
+        def submit():
+            # Round-robin across the pools, so they all get going at once.
+            more = True
+            while more:
+                more = False
+                for pool, queue in queues.items():
+                    if queue and running[pool] < per_pool:
+                        i = queue.popleft()
+                        running[pool] += 1
+                        fs[i] = f = executor.submit(run, *items[i])
+                        pending[f] = pool
+                        more = True
+
+        submit()
+        while pending:
+
+            done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for f in done:
+                running[pending.pop(f)] -= 1
+            submit()
+
+            while next_i in fs and fs[next_i].done():
+                output, this_code = fs.pop(next_i).result()
+                sys.stdout.write(output)
+                sys.stdout.flush()
+                code = code or this_code
+                next_i += 1
+
+    return code
+
+
+def get_usedbysnapshots(volume):
+    try:
+        output = subprocess.check_output(listing.ZFS_CMD + ['get', '-Hp', '-o', 'value', 'usedbysnapshots', volume])
+    except subprocess.CalledProcessError:
+        return
+    return int(output.strip())
+
+
 def main():
 
 
@@ -29,13 +236,24 @@ def main():
     parser.add_argument('-n', '--dry-run', action='store_true')
     parser.add_argument('-y', '--yes', action='store_true')
 
-    parser.add_argument('-v', '--verbose', action='count')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('--zfs', help="Command to run instead of `sudo zfs`.")
+    parser.add_argument('--max-arg-bytes', type=int, default=100000,
+        help="How long the names given to one zfs call may be (in total).")
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+        help="How many datasets to prune at once.")
+    parser.add_argument('--per-pool', type=int, default=2,
+        help="How many datasets in any one pool to prune at once.")
 
     parser.add_argument('command', choices=['auto', 'snapshot', 'prune', 'prune-timed', 'prune-empty'])
     parser.add_argument('volumes', nargs='*')
 
     args = parser.parse_args()
 
+    if args.zfs:
+        listing.ZFS_CMD = shlex.split(args.zfs)
+    zfs = listing.ZFS_CMD
+
 
     timestamp = time.strftime('%Y-%m-%dT%H:%M:%S%z')
 
@@ -45,34 +263,131 @@ def main():
     do_prune_empty = args.command in ('auto', 'prune', 'prune-empty')
 
 
-    def destroy(snapshot):
-        cmd = ['sudo', 'zfs', 'destroy', snapshot]
-        if args.verbose:
-            print('    $', ' '.join(cmd))
-        if not args.dry_run:
+    # Volume to the snapshots we've decided to destroy; they are all done
+    # together at the end.
+    doomed = {}
+
+    # How the emptiness of snapshots was decided (once it got past the size).
+    stats = collections.Counter()
+    stats_lock = threading.Lock()
+
+    def count(key):
+        with stats_lock:
+            stats[key] += 1
+
+    def destroy_all(datasets):
+        """Destroy everything that is doomed, in as few calls as we can.
+
+        Each call is for one volume, with runs of snapshots given as ranges
+        and the rest as a comma separated list.
+
+        """
+
+        total = sum(len(x) for x in doomed.values())
+        print('Destroying {} snapshots across {} datasets:'.format(total, len(doomed)))
+        for volume, snapshots in doomed.items():
+            print('    {:5d} {}'.format(len(snapshots), volume))
+
+        if args.dry_run:
+            yes = True
+        else:
             yes = args.yes
             if not yes:
-                res = raw_input('Delete %s ? [yN]: ' % snapshot).strip()
+                res = input('Destroy them all? [yN]: ').strip()
                 yes = res.lower() in ('y', 'yes')
-            if yes:
-                subprocess.check_call(cmd)
+        if not yes:
+            return 0
+
+        return run_per_dataset(destroy_volume,
+            [(volume, (snapshots, datasets[volume])) for volume, snapshots in doomed.items()],
+            args.jobs, args.per_pool,
+        )
+
+    def destroy_volume(volume, snapshots, dataset, log):
+
+        code = 0
+        before = dataset.usedbysnapshots
+
+        for batch in iter_destroy_args(volume, snapshots, dataset.order, args.max_arg_bytes):
+
+            cmd = zfs + ['destroy', batch]
+            if args.verbose:
+                log('$', ' '.join(cmd))
+            if args.dry_run:
+                continue
+
+            this_code = subprocess.call(cmd)
+            code = code or this_code
+            if this_code:
+                log('ERROR: Non-zero return code {} from: {}'.format(this_code, ' '.join(cmd)))
+
+            # The space can take a little while to be freed, but this is
+            # the best we can cheaply tell.
+            after = get_usedbysnapshots(volume)
+            if after is not None:
+                log('Freed {} from {}'.format(format_bytes(max(0, before - after)), volume))
+                before = after
+
+        return code
+
+
+    def snapshot(names):
+        """Snapshot all the names in as few calls as we can.
+
+        Each call is one TXG (and so they are consistent with each other). If
+        one fails then nothing in it was made, so we go one at a time to find
+        out which are the problem.
+
+        :returns: Dict of name to return code.
+
+        """
+
+        codes = {}
+
+        for batch in iter_batches(names, args.max_arg_bytes):
+
+            cmd = zfs + ['snapshot'] + batch
+            if args.verbose > 1:
+                print('$', ' '.join(cmd))
+            if args.dry_run:
+                codes.update(dict.fromkeys(batch, 0))
+                continue
+
+            this_code = subprocess.call(cmd)
+            if not this_code:
+                codes.update(dict.fromkeys(batch, 0))
+                continue
+
+            if len(batch) == 1:
+                print('ERROR: Non-zero return code {} from: {}'.format(this_code, ' '.join(cmd)))
+                codes[batch[0]] = this_code
+                continue
+
+            print('ERROR: Non-zero return code {} from snapshotting {} at once; trying one at a time.'.format(this_code, len(batch)))
+            for name in batch:
+                cmd = zfs + ['snapshot', name]
+                if args.verbose > 1:
+                    print('$', ' '.join(cmd))
+                codes[name] = this_code = subprocess.call(cmd)
+                if this_code:
+                    print('ERROR: Non-zero return code {} from: {}'.format(this_code, ' '.join(cmd)))
+
+        return codes
 
 
     code = 0
 
-    for line in subprocess.check_output(['sudo', 'zfs', 'list', '-H', '-o', 'name,autosnap:autosnap,autosnap:autoprune']).splitlines():
-        
-        line = line.strip().decode()
-        if not line:
-            continue
+    # Everything (including all of the snapshots) in one go, rather than
+    # a `zfs list` per volume.
+    datasets = list_datasets(zfs, args.verbose)
 
-        volume, is_auto_snap, is_auto_prune = line.strip().split('\t')
+    todo = []
+    for dataset in datasets:
 
-        is_auto_snap  = is_auto_snap.upper() in ('1', 'Y', 'YES', 'T', 'TRUE', 'ON')
-        is_auto_prune = is_auto_prune.upper() in ('1', 'Y', 'YES', 'T', 'TRUE', 'ON')
+        volume = dataset.name
 
-        do_this_snap = is_auto_snap
-        do_this_prune = do_this_snap or is_auto_prune
+        do_this_snap = dataset.auto_snap
+        do_this_prune = do_this_snap or dataset.auto_prune
 
         if args.volumes:
             if volume in args.volumes:
@@ -90,54 +405,45 @@ def main():
 
         if not (do_this_snap or do_this_prune):
             continue
-        
-        if args.verbose:
-            print()
-            print(volume)
-            print('=' * 20)
-
-        if do_this_snap and do_snapshot:
-            cmd = ['sudo', 'zfs', 'snapshot', '{}@{}'.format(volume, timestamp)]
-            if args.verbose > 1:
-                print('$', ' '.join(cmd))
-            if not args.dry_run:
-                this_code = subprocess.call(cmd)
-                code = code or this_code
-                if this_code:
-                    print('ERROR: Non-zero return code {} from: {}'.format(this_code, ' '.join(cmd)))
-                    continue
-
-        if not do_this_prune:
-            continue
-        if not (do_prune_timed or do_prune_empty):
-            continue
 
-        snapshots = []
+        todo.append((dataset, do_this_snap, do_this_prune))
+
+    # Take all of the snapshots first, in as few calls as we can.
+    failed = set()
+    if do_snapshot:
+        names = {'{}@{}'.format(d.name, timestamp): d for d, do_this_snap, _ in todo if do_this_snap}
+        for name, this_code in snapshot(list(names)).items():
+            code = code or this_code
+            if this_code:
+                failed.add(names[name].name)
+            elif not args.dry_run:
+                # So it is considered along with the rest. What it has written
+                # is what the dataset had when we listed it (which is only
+                # the moment before), so the last one can be judged by that.
+                dataset = names[name]
+                info = parse_snapshot(name, '0', '-', '-', args.verbose)
+                if info:
+                    dataset.snapshots.append(info)
+                dataset.order.append(name)
+                if dataset.live_written is not None:
+                    dataset.written[name] = dataset.live_written
+
+    def prune(volume, dataset, log):
+
+        to_destroy = doomed[volume]
+
+        def destroy(snapshot):
+            if args.verbose:
+                log('    destroy', snapshot)
+            to_destroy.append(snapshot)
 
-        for line in subprocess.check_output(['sudo', 'zfs', 'list',
-            '-t', 'snapshot',
-            '-r', '-d', '1',
-            '-Hp', '-o', 'name,used,autosnap:maxage,autosnap:_nonempty',
-            volume,
-        ]).splitlines():
-            line = line.strip().decode()
-            if not line:
-                continue
-            snapshot, used, maxage, nonempty = (x.strip() for x in line.split('\t'))
-            try:
-                maxage = None if maxage == '-' else int(maxage)
-            except ValueError:
-                print(f"Snapshot {snapshot} has malformed maxage {maxage!r}")
-                maxage = None
-            raw_ctime = snapshot.split('@', 1)[1]
-            ctime = parse_datetime(raw_ctime)
-            if not ctime:
-                if args.verbose > 1:
-                    print('Could not parse:', snapshot)
-                continue
-            snapshots.append((snapshot, ctime, maxage, int(used), nonempty))
+        if args.verbose:
+            log()
+            log(volume)
+            log('=' * 20)
 
-        snapshots.sort()
+        snapshots = sorted(dataset.snapshots)
+        order_index = dict((name, i) for i, name in enumerate(dataset.order))
 
         if do_prune_empty:
             # Skip the last, and go backwards so we can pop them out
@@ -146,54 +452,46 @@ def main():
             for i, (snapshot, raw_ctime, maxage, used, nonempty) in to_check:
 
                 if args.verbose > 1:
-                    print('%s -> %s' % (snapshot, used))
+                    log('%s -> %s' % (snapshot, used))
 
                 # Obviously too large.
                 if used > 1024**2: #102400: # 100kB.
                     continue
 
+                next_snapshot = snapshots[i + 1][0]
+                next_snapname = next_snapshot.split('@', 1)[1]
+
                 # We've already checked it.
                 if nonempty == '1':
                     continue
-
-                if used:
-
-                    cmd = ['sudo', 'zfs', 'diff', '-FH', snapshot, snapshots[i + 1][0]]
-                    if args.verbose:
-                        print('    $', ' '.join(cmd))
-                    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-
-                    empty = True
-                    for line in proc.stdout:
-
-                        line = line.strip().decode()
-                        if not line:
-                            continue
-
-                        line_parts = line.split('\t')
-                        op = line_parts[0]
-                        type_ = line_parts[1]
-                        path = line_parts[2]
-
-                        # Don't care about metadata on directories.
-                        if op == 'M' and type_ == '/':
-                            continue
-
-                        # Don't care about a few little files.
-                        name = os.path.basename(path)
-                        if name in IGNORE_NAMES:
-                            continue
-
-                        if args.verbose:
-                            print('      Found change:', path)
+                if nonempty == '0@' + next_snapname:
+                    count('cached')
+
+                elif used:
+
+                    # How much was written between them; nothing means there
+                    # aren't any changes, and a lot means there obviously are.
+                    # Anything else could just be directory metadata, so we
+                    # have to look.
+                    written = get_written_between(dataset, snapshot, next_snapshot, order_index)
+                    if written == 0:
+                        count('written')
+                        empty = True
+                    elif written is not None and written > 1024**2:
+                        count('written')
                         empty = False
-                        break
+                    else:
+                        count('diffed')
+                        empty = is_diff_empty(snapshot, next_snapshot, args.verbose, log)
+
+                    # Remember either way, so we never diff them again.
+                    value = '0@' + next_snapname if empty else '1'
+                    cmd = zfs + ['set', 'autosnap:_nonempty=' + value, snapshot]
+                    if args.verbose > 1:
+                        log('$', ' '.join(cmd))
+                    subprocess.check_call(cmd)
 
                     if not empty:
-                        cmd = ['sudo', 'zfs', 'set', 'autosnap:_nonempty=1', snapshot]
-                        if args.verbose > 1:
-                            print('$', ' '.join(cmd))
-                        subprocess.check_call(cmd)
                         continue
 
                 # At this point they are empty!
@@ -205,13 +503,50 @@ def main():
         for snapshot, raw_ctime, maxage, used, nonempty in sorted(snapshots):
             label = labels.get(snapshot)
             if args.verbose:
-                print(f'{label or "-":7s} {snapshot}')
+                log(f'{label or "-":7s} {snapshot}')
             if not label:
                 destroy(snapshot)
 
         if args.verbose:
-            print()
-        
- 
-main()
+            log()
+
+        return 0
+
+    to_prune = []
+    for dataset, do_this_snap, do_this_prune in todo:
+
+        # We don't prune if we couldn't snapshot.
+        if dataset.name in failed:
+            continue
+
+        if not do_this_prune:
+            continue
+        if not (do_prune_timed or do_prune_empty):
+            continue
+
+        # Reserve their spots so they are destroyed in order.
+        doomed[dataset.name] = []
+        to_prune.append((dataset.name, (dataset, )))
+
+    this_code = run_per_dataset(prune, to_prune, args.jobs, args.per_pool)
+    code = code or this_code
+
+    if do_prune_empty and stats:
+        print('Emptiness: {} diffed, {} avoided ({} by written, {} cached)'.format(
+            stats['diffed'], stats['written'] + stats['cached'], stats['written'], stats['cached'],
+        ))
+
+    for volume, snapshots in list(doomed.items()):
+        if not snapshots:
+            del doomed[volume]
+
+    if doomed:
+        this_code = destroy_all(dict((d.name, d) for d in datasets))
+        code = code or this_code
+
+    return code
+
+
+if __name__ == '__main__':
+    exit(main())
 
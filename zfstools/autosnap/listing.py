@@ -0,0 +1,117 @@
+import collections
+import os
+import shlex
+import subprocess
+
+from .schedule import parse_datetime
+
+
+# How we run zfs; ZFSTOOLS_ZFS may replace it with a command line, e.g. to
+# use fakezfs.py.
+ZFS_CMD = shlex.split(os.environ.get('ZFSTOOLS_ZFS', '')) or ['sudo', 'zfs']
+
+TRUE_VALUES = set(('1', 'Y', 'YES', 'T', 'TRUE', 'ON'))
+
+
+# The snapshots are those we understand, sorted by name; order is the names of
+# all of them, by createtxg, and written is how much each of them has that was
+# written since the one before. live_written is how much the dataset itself
+# has since the last one (i.e. what a snapshot taken now would have).
+Dataset = collections.namedtuple('Dataset', 'name auto_snap auto_prune usedbysnapshots snapshots order written live_written')
+SnapshotInfo = collections.namedtuple('SnapshotInfo', 'name ctime maxage used nonempty')
+
+
+# What we get for everything, in one go.
+PROPERTIES = (
+    'type',
+    'name',
+    'used',
+    'createtxg',
+    'usedbysnapshots',
+    'written',
+    'autosnap:autosnap',
+    'autosnap:autoprune',
+    'autosnap:maxage',
+    'autosnap:_nonempty',
+)
+
+
+def list_datasets(zfs_cmd=None, verbose=0):
+    """Get every dataset and all of their snapshots with a single `zfs list`.
+
+    :returns: List of :class:`Dataset` in the order zfs gave them, each with
+        a list of :class:`SnapshotInfo` (of the snapshots we can parse the
+        time of), sorted by name.
+
+    """
+
+    cmd = (zfs_cmd or ZFS_CMD) + ['list', '-t', 'all', '-Hp', '-o', ','.join(PROPERTIES)]
+    if verbose > 1:
+        print('$', ' '.join(cmd))
+
+    datasets = []
+
+    # zfs lists each dataset before its snapshots, but we don't rely on it.
+    snapshots = collections.defaultdict(list)
+    orders = collections.defaultdict(list)
+    written = collections.defaultdict(dict)
+
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    for line in proc.stdout:
+
+        line = line.strip().decode()
+        if not line:
+            continue
+
+        type_, name, used, createtxg, usedbysnapshots, written_, auto_snap, auto_prune, maxage, nonempty = (x.strip() for x in line.split('\t'))
+
+        if type_ == 'snapshot':
+            volume = name.split('@', 1)[0]
+            orders[volume].append((int(createtxg), name))
+            if written_ != '-':
+                written[volume][name] = int(written_)
+            info = parse_snapshot(name, used, maxage, nonempty, verbose)
+            if info:
+                snapshots[volume].append(info)
+
+        elif type_ in ('filesystem', 'volume'):
+            dataset = Dataset(
+                name,
+                auto_snap.upper() in TRUE_VALUES,
+                auto_prune.upper() in TRUE_VALUES,
+                int(usedbysnapshots),
+                snapshots[name],
+                orders[name],
+                written[name],
+                None if written_ == '-' else int(written_),
+            )
+            datasets.append(dataset)
+
+    ret = proc.wait()
+    if ret:
+        raise subprocess.CalledProcessError(ret, cmd)
+
+    for dataset in datasets:
+        dataset.snapshots.sort()
+        dataset.order.sort()
+        dataset.order[:] = [name for _, name in dataset.order]
+
+    return datasets
+
+
+def parse_snapshot(name, used, maxage, nonempty, verbose=0):
+
+    try:
+        maxage = None if maxage == '-' else int(maxage)
+    except ValueError:
+        print(f"Snapshot {name} has malformed maxage {maxage!r}")
+        maxage = None
+
+    raw_ctime = name.split('@', 1)[1]
+    ctime = parse_datetime(raw_ctime)
+    if not ctime:
+        if verbose > 1:
+            print('Could not parse:', name)
+        return
+
+    return SnapshotInfo(name, ctime, maxage, int(used), nonempty)
@@ -3,12 +3,28 @@ import re
 import os
 import random
 import collections
+import heapq
+import itertools
+import json
+import struct
+import time
+import zlib
 
 import click
 
+from .utils import get_cache_dir
 
-# TODO: Do this elsewhere...
-CACHE_ROOT = '/mnt/tank/scratch/zfs-diffs'
+
+# How much the cached diffs (in total) may take before the least recently used
+# are removed.
+CACHE_BYTES = 10 * 1024 * 1024 * 1024
+
+# Roughly how much (uncompressed) goes into each frame of a cached diff.
+FRAME_SIZE = 1024 * 1024
+
+# How much of a diff is sorted in memory at once when caching it; bigger ones
+# are sorted in runs of this that are then merged.
+SORT_RUN_SIZE = 256 * 1024 * 1024
 
 
 OP_REMOVE = '-' # The path has been removed
@@ -29,65 +45,381 @@ TYPE_REG = 'F' # Regular file
 
 DiffItem = collections.namedtuple('DiffItem', 'relpath time type op path new_relpath')
 
+# A chunk of a diff, by column. The new_relpaths are empty if not a rename.
+DiffBatch = collections.namedtuple('DiffBatch', 'times types ops relpaths new_relpaths')
+
+# How much of the diff we read at a time.
+CHUNK_SIZE = 1024 * 1024
+
+
 def decode(x):
     return re.sub(rb'\\(\d{4})', lambda m: bytes((int(m.group(1), 8), )), x).decode()
 
 
 def iter_diff(volname, snap1, snap2, cache_key=None):
+    prefix = f'/mnt/{volname}/'
+    for batch in iter_diff_batches(volname, snap1, snap2, cache_key):
+        for time, type_, op, relpath, new_relpath in zip(*batch):
+            yield DiffItem(relpath, time, type_, op, prefix + relpath, new_relpath or None)
 
+
+def iter_diff_batches(volname, snap1, snap2, cache_key=None, subdir=None):
+    """Iterate DiffBatch'es of the changes between two snapshots.
+
+    :param str subdir: Only what is under this relpath is wanted; if the diff
+        is cached then only the parts of it which could have that are read
+        (but there will still be plenty of other things).
+
+    """
     abs_prefix_len = len(volname) + 6 # /mnt/{volname}/xxx
+    chunks = _iter_diff(volname, snap1, snap2, cache_key, subdir, abs_prefix_len)
+    return parse_diff(chunks, abs_prefix_len)
 
-    for line in _iter_diff(volname, snap1, snap2, cache_key):
 
-        parts = line.rstrip().split(b'\t')
-        time = float(parts[0])
-        op = parts[1]
-        type_ = parts[2]
-        path = decode(parts[3])
-        relpath = path[abs_prefix_len:]
-        
-        if op == 'R':
-            new_relpath = decode(parts[4])[abs_prefix_len:]
-        else:
-            new_relpath = None
+def parse_diff(chunks, prefix_len=0):
+    """Parse chunks of raw `zfs diff -tFH` output into DiffBatch'es.
+
+    Each chunk is split into columns by one regex, so there isn't any Python
+    run per line. Escapes (e.g. ``\\0040`` for a space) are mostly undone
+    on the whole chunk before that.
+
+    """
+
+    # The path prefix is skipped by the regex (the same as slicing it off).
+    skip = f'[^\\t\\n]{{0,{prefix_len}}}'
+    pattern = re.compile(
+        rf'^([^\t\n]*)\t([^\t\n]*)\t([^\t\n]*)\t{skip}([^\t\n]*)(?:\t{skip}([^\t\n]*))?$',
+        re.MULTILINE,
+    )
+
+    rest = b''
+
+    for chunk in itertools.chain(chunks, (b'\n', )):
+
+        chunk = rest + chunk
+        end = chunk.rfind(b'\n') + 1
+        rest = chunk[end:]
+        if not end:
+            continue
+
+        chunk = chunk[:end]
+
+        # Everything but tabs, newlines, and backslashes can be unescaped
+        # before we split it up. Those are left for the (very few) paths
+        # which still have a backslash after.
+        if b'\\' in chunk:
+            chunk = _escape_pattern.sub(_unescape, chunk)
+
+        rows = pattern.findall(chunk.decode('utf8', 'surrogateescape'))
+        if not rows:
+            continue
+
+        times, ops, types, relpaths, new_relpaths = zip(*rows)
+
+        if b'\\' in chunk:
+            relpaths = _decode_column(relpaths)
+            new_relpaths = _decode_column(new_relpaths)
 
-        yield DiffItem(relpath, time, type_, op, path, new_relpath)
+        yield DiffBatch(tuple(map(float, times)), types, ops, relpaths, new_relpaths)
 
 
-def _iter_diff(volname, snap1, snap2, cache_key):
+_escape_pattern = re.compile(rb'\\(?!0011|0012|0134)(\d{4})')
+_unescape = lambda m: bytes((int(m.group(1), 8), ))
 
-    cache_dir = os.path.join(CACHE_ROOT, volname)
-    if not os.path.exists(cache_dir):
-        os.makedirs(cache_dir)
 
-    cache_path = os.path.join(cache_dir, f'{snap1},{snap2}{"," if cache_key else ""}{cache_key or ""}.zfsdiff')
+def _decode_column(values):
+    return tuple(decode(x.encode('utf8', 'surrogateescape')) if '\\' in x else x for x in values)
+
+
+def _iter_diff(volname, snap1, snap2, cache_key, subdir, prefix_len):
+
+    cache_dir = get_cache_dir('diffs', volname)
+    cache_path = os.path.join(cache_dir, f'{snap1},{snap2}{"," if cache_key else ""}{cache_key or ""}.zdiff')
 
     if os.path.exists(cache_path):
         click.echo(f"Loading ZFS diff from cache: {cache_path}")
-        with open(cache_path, 'rb') as fh:
-            yield from fh
+        # Keep track of what was used for the eviction.
+        os.utime(cache_path)
+        yield from read_cache(cache_path, subdir)
         return
 
     tmp_path = f'{cache_path}.{random.random()}'
     with open(tmp_path, 'wb') as fh:
         cmd = ['zfs', 'diff', '-tFH', f'{volname}@{snap1}', f'{volname}@{snap2}']
         click.secho(f"Pulling ZFS diff for first time\n    {' '.join(cmd)}", fg='yellow')
-        proc = subprocess.Popen(cmd, bufsize=1, stdout=subprocess.PIPE)
-        for line in proc.stdout:
-            fh.write(line)
-            yield line
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        for chunk in iter(lambda: proc.stdout.read1(CHUNK_SIZE), b''):
+            fh.write(chunk)
+            yield chunk
 
+    # What we've given so far is only part of it, and anything replaying it
+    # can't carry on as if that was everything.
     ret = proc.wait()
     if ret:
-        click.secho(f"WARNING: zfs diff returned {ret}", fg='yellow')
-    if not ret:
+        os.unlink(tmp_path)
+        raise subprocess.CalledProcessError(ret, cmd)
+
+    write_cache(tmp_path, cache_path, prefix_len)
+    os.unlink(tmp_path)
+    evict_cache()
+
+
+# Cached diffs are a series of zlib compressed frames of the raw zfs diff
+# lines, sorted by path, and then a (compressed) JSON index of them. Renames
+# are put in their own frames since their new path could be anywhere. The
+# trailer is the offset and size of the index.
+_MAGIC = b'ZRDIFF1\n'
+_TRAILER = struct.Struct('<QQ')
+
+# Paths which are only these are the same escaped or not, so we can compare
+# them against the raw lines.
+_plain_path = re.compile(r'[\w./+,=@%-]*')
+
+
+def write_cache(raw_path, cache_path, prefix_len):
+
+    def key(line):
+        return line.split(b'\t', 4)[3][prefix_len:]
+
+    tmp_path = f'{cache_path}.{random.random()}'
+    renames_path = tmp_path + '.renames'
+    run_paths = []
+
+    try:
+
+        # Split out the renames, and sort the rest in runs.
+        run = []
+        run_size = 0
+        with open(raw_path, 'rb') as fh, open(renames_path, 'wb') as renames:
+            for line in fh:
+                if line.count(b'\t') < 3:
+                    continue
+                if not line.endswith(b'\n'):
+                    line += b'\n'
+                if line.split(b'\t', 2)[1] == b'R':
+                    renames.write(line)
+                    continue
+                run.append(line)
+                run_size += len(line)
+                if run_size >= SORT_RUN_SIZE:
+                    run_paths.append(f'{tmp_path}.run{len(run_paths)}')
+                    _write_run(run_paths[-1], run, key)
+                    run = []
+                    run_size = 0
+        run.sort(key=key)
+
+        with open(tmp_path, 'wb') as fh:
+
+            fh.write(_MAGIC)
+            index = []
+
+            with open(renames_path, 'rb') as renames:
+                _write_frames(fh, index, renames, key, True)
+
+            # The merge is stable, and the runs are in the order we read them,
+            # so this is the same as sorting them all at once.
+            runs = [_iter_run(path) for path in run_paths]
+            _write_frames(fh, index, heapq.merge(*runs, run, key=key), key, False)
+
+            offset = fh.tell()
+            data = zlib.compress(json.dumps(index).encode())
+            fh.write(data)
+            fh.write(_TRAILER.pack(offset, len(data)))
+
         os.rename(tmp_path, cache_path)
 
+    finally:
+        for path in [tmp_path, renames_path] + run_paths:
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+def _write_run(path, lines, key):
+    lines.sort(key=key)
+    with open(path, 'wb') as fh:
+        fh.writelines(lines)
+
+
+def _iter_run(path):
+    with open(path, 'rb') as fh:
+        yield from fh
+
+
+def _write_frames(fh, index, lines, key, is_rename):
+
+    frame = []
+    size = 0
+
+    def flush():
+        data = zlib.compress(b''.join(frame), 1)
+        index.append(dict(
+            first=key(frame[0]).decode('latin1'),
+            last=key(frame[-1]).decode('latin1'),
+            offset=fh.tell(),
+            size=len(data),
+            rename=is_rename,
+        ))
+        fh.write(data)
+
+    for line in lines:
+        frame.append(line)
+        size += len(line)
+        if size >= FRAME_SIZE:
+            flush()
+            frame = []
+            size = 0
+
+    if frame:
+        flush()
+
+
+def read_cache(cache_path, subdir=None):
+    """Iterate the raw chunks of a cached diff.
+
+    :param str subdir: Only the frames which could have something under this
+        relpath (and the renames) are read.
+
+    """
+
+    # Only a plain prefix can be compared against the (escaped) raw paths.
+    # Everything under it sorts between it and the next directory name.
+    lo = hi = None
+    if subdir and _plain_path.fullmatch(subdir):
+        lo = subdir.rstrip('/') + '/'
+        hi = lo[:-1] + '0' # The next character after '/'.
+
+    with open(cache_path, 'rb') as fh:
+
+        if fh.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError(f"Bad diff cache: {cache_path}")
+
+        fh.seek(-_TRAILER.size, os.SEEK_END)
+        offset, size = _TRAILER.unpack(fh.read(_TRAILER.size))
+        fh.seek(offset)
+        index = json.loads(zlib.decompress(fh.read(size)))
+
+        for frame in index:
+
+            if lo and not frame['rename'] and (frame['last'] < lo or frame['first'] >= hi):
+                continue
+
+            fh.seek(frame['offset'])
+            yield zlib.decompress(fh.read(frame['size']))
+
+
+def evict_cache(max_bytes=None):
+    """Remove the least recently used cached diffs until under the limit."""
+
+    max_bytes = CACHE_BYTES if max_bytes is None else max_bytes
+
+    entries = []
+    for dir_path, _, names in os.walk(get_cache_dir('diffs')):
+        for name in names:
+            if name.endswith('.zdiff'):
+                path = os.path.join(dir_path, name)
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+
+    total = sum(x[1] for x in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        click.echo(f"Evicting ZFS diff from cache: {path}")
+        os.unlink(path)
+        total -= size
+
+
+def make_synthetic_diff(path, count, prefix='/mnt/tank/test/'):
+    """Write something that looks like `zfs diff -tFH` output."""
+
+    rand = random.Random(count)
+    ops = OP_MODIFY * 6 + OP_CREATE * 2 + OP_REMOVE + OP_RENAME
+
+    with open(path, 'w') as fh:
+        for i in range(count):
+            op = rand.choice(ops)
+            type_ = TYPE_DIR if rand.random() < 0.1 else TYPE_REG
+            name = f'dir{i % 1000:03d}/file{i}'
+            # Some have things which need escaping (a space, an é, a tab, and
+            # a backslash), the same way zfs diff does it.
+            if rand.random() < 0.05:
+                name += rand.choice(('\\0040', '\\0303\\0251', '\\0011', '\\0134'))
+            line = f'{1500000000 + i / 1000:.9f}\t{op}\t{type_}\t{prefix}{name}'
+            if op == OP_RENAME:
+                line += f'\t{prefix}{name}.new'
+            fh.write(line + '\n')
+
+
+def _parse_lines(fh, prefix_len):
+    # How we used to do it, for comparison.
+    for line in fh:
+        parts = line.rstrip().split(b'\t')
+        path = decode(parts[3])
+        op = parts[1].decode()
+        new_relpath = decode(parts[4])[prefix_len:] if op == OP_RENAME else None
+        yield DiffItem(path[prefix_len:], float(parts[0]), parts[2].decode(), op, path, new_relpath)
+
 
 if __name__ == '__main__':
 
-    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench', type=int, metavar='COUNT',
+        help="Time parsing (and caching) a synthetic diff of this many lines.")
+    parser.add_argument('args', nargs='*', metavar='volname snap1 snap2')
+    args = parser.parse_args()
+
+    if args.bench:
+
+        import tempfile
+
+        prefix = '/mnt/tank/test/'
+        with tempfile.TemporaryDirectory() as tmp:
+
+            path = os.path.join(tmp, 'synthetic.zfsdiff')
+            make_synthetic_diff(path, args.bench, prefix)
+            print(f'{args.bench} lines, {os.path.getsize(path) / 1024 / 1024:.1f}MB')
+
+            with open(path, 'rb') as fh:
+                start = time.monotonic()
+                old = list(_parse_lines(fh, len(prefix)))
+                print(f'    by line: {time.monotonic() - start:.2f}s')
+
+            with open(path, 'rb') as fh:
+                start = time.monotonic()
+                batches = list(parse_diff(iter(lambda: fh.read1(CHUNK_SIZE), b''), len(prefix)))
+                print(f'    batched: {time.monotonic() - start:.2f}s')
+
+            new = [
+                DiffItem(relpath, time_, type_, op, prefix + relpath, new_relpath or None)
+                for batch in batches
+                for time_, type_, op, relpath, new_relpath in zip(*batch)
+            ]
+            if old != new:
+                print('    MISMATCH')
+
+            cache_path = os.path.join(tmp, 'synthetic.zdiff')
+            start = time.monotonic()
+            write_cache(path, cache_path, len(prefix))
+            print(f'    cached: {os.path.getsize(cache_path) / 1024 / 1024:.1f}MB in {time.monotonic() - start:.2f}s')
+
+            start = time.monotonic()
+            cached = [x for batch in parse_diff(read_cache(cache_path), len(prefix)) for x in zip(*batch)]
+            print(f'    read all: {time.monotonic() - start:.2f}s')
+            if len(cached) != len(new):
+                print('    MISMATCH')
+
+            subdir = 'dir123'
+            start = time.monotonic()
+            cached = [x for batch in parse_diff(read_cache(cache_path, subdir), len(prefix)) for x in zip(*batch)]
+            print(f'    read {subdir}: {time.monotonic() - start:.2f}s ({len(cached)} items)')
+            expected = set(x for x in new if x.relpath.startswith(subdir + '/') or (x.new_relpath or '').startswith(subdir + '/'))
+            got = set(DiffItem(r, t, ty, op, prefix + r, nr or None) for t, ty, op, r, nr in cached)
+            if expected - got:
+                print('    MISMATCH')
 
-    for x in iter_diff(*sys.argv[1:]):
-        print(x)
+    else:
+        for x in iter_diff(*args.args):
+            print(x)
 
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""A stand-in for ``zfs``, for when there isn't any ZFS around (or enough of it).
+
+Pretends there is a pool (or a comma separated few) with ``--datasets``
+datasets under each, each with ``--snapshots`` hourly snapshots up to now.
+Everything about them is derived from their names, so it is the same from
+one call to the next. ``list`` and
+``get`` answer with whatever properties were asked for; ``snapshot``,
+``destroy``, ``set`` and ``diff`` succeed without doing anything, unless one
+of their names matches ``--fail``.
+
+Use it via ZFSTOOLS_ZFS, e.g.::
+
+    ZFSTOOLS_ZFS="python -m zfstools.fakezfs -d 800 -s 125" zfs-autosnap -n prune
+
+or, to check that the snapshot just taken is judged by its written (and so
+reports "0 diffed")::
+
+    ZFSTOOLS_ZFS="python -m zfstools.fakezfs -d 4 -s 1 --newest-used 4096 --live-written 0" zfs-autosnap -y auto
+
+"""
+
+import argparse
+import datetime as dt
+import re
+import sys
+import time
+import zlib
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--pool', default='tank',
+        help="Pool name, or a comma separated list of them.")
+    parser.add_argument('-d', '--datasets', type=int, default=100)
+    parser.add_argument('-s', '--snapshots', type=int, default=1000)
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+        help="Seconds to sleep per call, to pretend to be the ioctls.")
+    parser.add_argument('-f', '--fail',
+        help="Regex of names that snapshot/destroy/set/diff fail on.")
+    parser.add_argument('--newest-used', type=int,
+        help="The used (and written) of the newest snapshot of each dataset.")
+    parser.add_argument('--live-written', type=int,
+        help="The written of each dataset (since its newest snapshot).")
+    parser.add_argument('command')
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    if args.latency:
+        time.sleep(args.latency)
+
+    opts, targets = parse_flags(args.args)
+
+    if args.command in ('list', 'get'):
+        return do_list(args, opts, targets)
+
+    if args.fail:
+        for target in targets:
+            for name in target.split(','):
+                if re.search(args.fail, name):
+                    print(f"cannot {args.command} '{name}': fake failure", file=sys.stderr)
+                    return 1
+
+    return 0
+
+
+def parse_flags(argv):
+    """Split up zfs style flags, e.g. ``-Hp -o name,used -tall``."""
+
+    opts = {}
+    targets = []
+
+    argv = list(argv)
+    while argv:
+        arg = argv.pop(0)
+        if not arg.startswith('-') or arg == '-':
+            targets.append(arg)
+            continue
+        flags = arg[1:]
+        while flags:
+            flag, flags = flags[0], flags[1:]
+            if flag in 'otsSd':
+                opts[flag] = flags or argv.pop(0)
+                break
+            opts[flag] = True
+
+    return opts, targets
+
+
+def iter_datasets(args):
+
+    now = dt.datetime.now().replace(minute=0, second=0, microsecond=0)
+
+    for pool in args.pool.split(','):
+        yield 'filesystem', pool, 0, False
+        for i in range(args.datasets):
+            name = f'{pool}/fake{i:04d}'
+            yield 'filesystem', name, 0, False
+            for j in range(args.snapshots):
+                ctime = now - dt.timedelta(hours=args.snapshots - j - 1)
+                yield 'snapshot', f'{name}@{ctime:%Y-%m-%dT%H:%M:%S}-0000', j + 1, j == args.snapshots - 1
+
+
+def get_value(args, type_, name, txg, newest, prop):
+
+    if prop == 'name':
+        return name
+    if prop == 'type':
+        return type_
+
+    seed = zlib.crc32(name.encode())
+
+    if prop == 'used' or prop == 'written':
+        if newest and args.newest_used is not None:
+            return str(args.newest_used)
+        if type_ != 'snapshot' and prop == 'written' and args.live_written is not None:
+            return str(args.live_written)
+        if type_ != 'snapshot':
+            return str(seed % 1000 * 1024 * 1024 * 1024)
+        # A third are empty, a third are small, and a third are big. The
+        # written is sometimes more than the used, when the next one shares it.
+        r = seed % 99
+        size = 0 if r < 33 else r * 1000 if r < 66 else r * 10 * 1024 * 1024
+        if prop == 'written' and not r % 4:
+            size += 4096
+        return str(size)
+
+    if prop == 'usedbysnapshots':
+        return str(seed % 100 * 1024 * 1024 * 1024) if type_ != 'snapshot' else '0'
+    if prop == 'createtxg':
+        return str(txg * 1000)
+    if prop == 'guid':
+        return str(seed)
+    if prop == 'creation':
+        return str(int(time.time()))
+    if prop == 'mountpoint':
+        return '/mnt/' + name if type_ != 'snapshot' else '-'
+
+    if prop == 'autosnap:autosnap' and type_ != 'snapshot':
+        return 'on' if name != name.split('/')[0] else '-'
+
+    return '-'
+
+
+def do_list(args, opts, targets):
+
+    if args.command == 'get':
+        # zfs get PROPS NAMES
+        props = targets.pop(0).split(',')
+        columns = opts.get('o', 'name,property,value,source').split(',')
+    else:
+        props = None
+        columns = opts.get('o', 'name,used').split(',')
+
+    types = opts.get('t', 'filesystem')
+    types = set(('filesystem', 'snapshot')) if types == 'all' else set(types.split(','))
+
+    out = sys.stdout
+    for type_, name, txg, newest in iter_datasets(args):
+
+        if args.command == 'list' and type_ not in types:
+            continue
+
+        if targets:
+            base = name.split('@')[0]
+            if name not in targets and not (opts.get('r') and base in targets):
+                continue
+
+        if props is None:
+            out.write('\t'.join(get_value(args, type_, name, txg, newest, col) for col in columns) + '\n')
+            continue
+
+        for prop in props:
+            row = dict(name=name, property=prop, value=get_value(args, type_, name, txg, newest, prop), source='-')
+            out.write('\t'.join(row[col] for col in columns) + '\n')
+
+
+if __name__ == '__main__':
+    exit(main())
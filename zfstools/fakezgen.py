@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""A stand-in for the ``zgen`` helper, for when there isn't any ZFS around.
+
+Speaks the same line protocol: reads ``dataset obj`` and writes back
+``dataset obj gen``, or ``dataset obj ERROR errno message``. The generation
+is derived from the object number so it is the same across snapshots, and
+every ``--missing``-th object doesn't exist.
+
+"""
+
+import argparse
+import errno
+import os
+import sys
+import time
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+        help="Seconds to sleep per lookup, to pretend to be an ioctl.")
+    parser.add_argument('-m', '--missing', type=int, default=97)
+    args = parser.parse_args()
+
+    out = sys.stdout
+
+    for line in sys.stdin:
+
+        parts = line.split()
+        if len(parts) != 2:
+            out.write('[zgen] ERROR while reading\n')
+            out.flush()
+            return 2
+
+        dataset, obj = parts
+        obj = int(obj)
+
+        if args.latency:
+            time.sleep(args.latency)
+
+        if args.missing and not obj % args.missing:
+            out.write(f'{dataset} {obj} ERROR {errno.ENOENT} {os.strerror(errno.ENOENT)}\n')
+        else:
+            out.write(f'{dataset} {obj} {obj % 1000 + 1}\n')
+
+        # Like zgen, flush every response.
+        out.flush()
+
+
+if __name__ == '__main__':
+    exit(main())
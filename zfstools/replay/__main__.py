@@ -4,9 +4,9 @@ import argparse
 import collections
 import datetime as dt
 import hashlib
+import itertools
 import os
 import pdb
-import random
 import re
 import shutil
 import stat
@@ -15,10 +15,14 @@ import subprocess
 import click
 
 from .. import diff
+from .. import utils
+from ..utils import format_bytes
 from .. import zdb
 from ..snapshots import get_snapshots, Snapshot
 from .index import Index
-from .processor import Processor
+from .journal import Journal
+from .processor import Processor, DEFAULT_DIR_MODE, DEFAULT_FILE_MODE
+from .scheduler import Scheduler
 
 
 class Job(object):
@@ -33,12 +37,44 @@ class Job(object):
     def dst_snapshot_name(self):
         return f'{self.dst_volume}@{self.dst_snapname}'
 
-    def run(self, proc, threads=1):
+    def run(self, proc, threads=1, next_job=None):
         raise NotImplementedError()
 
+    def can_resume(self):
+        """If a previous run of this job was interrupted and can be picked up."""
+        return False
+
+    def can_prefetch(self):
+        """If prefetch can run while the jobs before this one are running."""
+        return False
+
+    def prefetch(self):
+        """Do the read-only prep work for run; called from another thread."""
+        raise NotImplementedError()
+
+    def prepare(self):
+        """Do (or wait for) the prep work for run; called just before it."""
+        pass
+
+    def hand_off(self, other):
+        """Give anything we've prepared that the other job can reuse."""
+        pass
+
 
 class SyncJob(Job):
 
+    # If ZFS jobs should only look at what `zfs diff` says has changed.
+    use_diff = False
+
+    # Files at least this big are checked for changes via their block pointers.
+    block_check_size = 50 * 1024 * 1024
+
+    # If those files should be merged by only the blocks whose pointers changed.
+    block_merge = False
+
+    # How many bytes of copies/merges may be running at once.
+    max_bytes_in_flight = 1024 * 1024 * 1024
+
     def __init__(self,
 
         dst_volume,
@@ -83,15 +119,41 @@ class SyncJob(Job):
 
         self.pre_bash = pre_bash
 
-        self._prename_root = os.path.join(target, f'.zfsreplay-{random.randrange(1e12)}')
+        self._euid = os.geteuid()
+        self._egid = os.getegid()
+
+        # These are named after the job so that a restarted job finds them.
+        key = hashlib.sha1(self.dst_snapshot_name.encode()).hexdigest()[:12]
+        self._prename_root = os.path.join(target, f'.zfsreplay-{key}')
+        self._journal_path = self._prename_root + '.journal'
+        self._prefetched = None
+        self._indexes = None
+        self._index_a = None
+        self._aidx = None
+        self._setgid = {}
+        self._target_setgid = True
+        self._break_links = set()
+        self._journal = None
+        self._journal_pending = []
+        self._resuming = False
+
         self._prename_dir = None
         self._prename_count = 0
         self._prename_group = None
 
-    def run(self, proc, threads=1):
+    def run(self, proc, threads=1, next_job=None):
 
         self._proc = proc
 
+        proc.dirty_dirs.clear()
+        counts_before = proc.counts.copy()
+
+        self._prename_count = 0
+        self._prename_group = None
+        self._journal = None
+        self._journal_pending = []
+        self._resuming = False
+
         if self.pre_bash:
             cmd = ['bash', '-c', self.pre_bash]
             if proc.verbose:
@@ -101,18 +163,25 @@ class SyncJob(Job):
 
         # 1. Get a full index of A and B. Assume T starts looking like A.
         # This is the paths and stats of all folders and files. Folders don't need their contents.
-        aidx = Index.get(self.src_root_a, ignore=self.ignore)
-        bidx = Index.get(self.src_root_b, ignore=self.ignore)
-        
+        # If we have a `zfs diff` then we only need to look at what it says changed.
+        aidx, bidx = self.prepare()
+        self.hand_off(next_job)
+        self._indexes = None
+
+        # What create_new needs to know about the target's directories.
+        self._aidx = aidx
+        self._setgid = {}
+        try:
+            self._target_setgid = bool(os.stat(self.target).st_mode & stat.S_ISGID)
+        except FileNotFoundError:
+            self._target_setgid = True
+
         # 2. Identify all AB pairs; this will be via `zfs diff` or inode, and then name.
         # - Same inode from/to link snapshot means the file has not changed.
         # - `zfs diff` will give us renames (because inodes are not reliable).
         # - Same ctime from/to zfs snapshot means the file has not changed.
         # - Same indirect block from/to zfs snapshot means the file has not changed.
-        
-        # In the future we should change this from pairs of files to sets of
-        # hardlinks. My two volumes don't currently have ANY hardlinks in them
-        # so I'm just going to ignore that for now.
+        # Hardlinks are paired like anything else, and then sorted out below.
 
         a_by_rel = aidx.by_rel.copy()
         b_by_rel = bidx.by_rel.copy()
@@ -130,6 +199,7 @@ class SyncJob(Job):
             if proc.verbose:
                 print("Scanning for inode sets")
 
+            candidates = []
             for inode, bnodes in bidx.by_ino.items():
 
                 # We only deal with files/links like this.
@@ -140,10 +210,22 @@ class SyncJob(Job):
                 if not anodes:
                     continue
 
+                candidates.append((anodes, bnodes))
+
+            # Look up all of the generations at once, since doing them one at a
+            # time is dominated by the round trips.
+            if self.is_zfs and candidates:
+                gens = zdb.get_gens(itertools.chain(
+                    ((self.src_snapshot_a.name, anodes[0].ino) for anodes, _ in candidates),
+                    ((self.src_snapshot_b.name, bnodes[0].ino) for _, bnodes in candidates),
+                ))
+
+            for anodes, bnodes in candidates:
+
                 if self.is_zfs:
 
-                    agen = zdb.get_gen(self.src_snapshot_a.name, anodes[0].ino)
-                    bgen = zdb.get_gen(self.src_snapshot_b.name, bnodes[0].ino)
+                    agen = gens[(self.src_snapshot_a.name, anodes[0].ino)]
+                    bgen = gens[(self.src_snapshot_b.name, bnodes[0].ino)]
 
                     if not (agen and bgen):
                         # This is disconcerting.
@@ -158,20 +240,11 @@ class SyncJob(Job):
                         # These are not actually the same inode.
                         continue
 
-                if len(anodes) > 1 or len(bnodes) > 1:
-                    click.secho("WARNING: There are hardlinks:", fg='yellow')
-                    for set_ in (anodes, bnodes):
-                        for node in set_:
-                            click.secho(f'    {node.path}', fg='yellow')
-
-                # Below here we don't deal with hardlinks at all.
-                # The author's dataset doesn't have any significant ones. Oops.
-
-                # We have them by inodes, so we don't need to look at them by path.
+                # We have them by inodes, so we don't need to look at them by
+                # path. Any other links will get paired by path (if they can).
                 a_by_rel.pop(anodes[0].relpath)
                 b_by_rel.pop(bnodes[0].relpath)
 
-                # Again... don't treat them as hardlinks.
                 pairs.append((anodes[0], bnodes[0]))
 
             if proc.verbose:
@@ -207,14 +280,27 @@ class SyncJob(Job):
             paths.update(b_by_rel)
             print(f"    {num_relpath_pairs} pairs from {len(paths) + num_relpath_pairs} remaining paths")
 
+        # Only the first of each set of hardlinked files in B gets its data
+        # written; the rest are linked to it once that is done.
+        links = self.get_links(aidx, bidx, pairs)
+
         # We MUST operate in this order:
         # - pre-move moving files aside
         # - remove old dirs/files
         # - create new dirs
         # - create new files and update existing
+        # - link the rest of the hardlinks
         # - set mtime on dirs
         # This is the only order that seems to deal with all proposed changes.
 
+        # Everything from here on changes the target, so record what we do as
+        # we go in case we need to pick it back up.
+        if self.is_resumable() and not proc.dry_run:
+            self._journal = Journal(self._journal_path, self.journal_header())
+            self._resuming = self._journal.open()
+            if self._resuming:
+                click.secho(f'Resuming from {self._journal_path}', fg='yellow')
+
         # Pre-move moving files/links.
         # This gets them out of directories that are going to be removed, and
         # out of the way of other files or directories that might go in their
@@ -227,56 +313,411 @@ class SyncJob(Job):
                 if group != self._prename_group:
                     self._prename_group = group
                     self._prename_dir = os.path.join(self._prename_root, f'{group:02x}')
-                    os.makedirs(self._prename_dir)
+                    os.makedirs(self._prename_dir, exist_ok=self._resuming)
                 b.prename_path = os.path.join(self._prename_dir, f'{node:02x}')
-                proc.prename(os.path.join(self.target, a.relpath), b.prename_path)
+                if self._is_done('prename', a.relpath):
+                    continue
+                apath = os.path.join(self.target, a.relpath)
+                # We may have died between doing it and writing it down.
+                if not (self._resuming and os.path.lexists(b.prename_path) and not os.path.lexists(apath)):
+                    proc.prename(apath, b.prename_path)
+                self._record('prename', a.relpath)
+
+        self._sync_journal()
 
         # Delete all files and directories that are in A but not B.
         # We're going in reverse so files are done before directories.
         for relpath, node in sorted(a_by_rel.items(), reverse=True):
+            if self._is_done('delete', relpath):
+                continue
             tpath = os.path.join(self.target, node.relpath)
-            if node.is_dir:
+            if self._resuming and not os.path.lexists(tpath):
+                pass
+            elif node.is_dir:
                 self._proc.rmdir(tpath)
             else:
                 self._proc.unlink(tpath)
+            self._record('delete', relpath)
+
+        self._sync_journal()
 
         # Create new directories.
         # Their mtimes will be set wrong if there are any contents added, so
         # we will defer that to later.
         for node in b_by_rel.values():
-            if node.is_dir:
+            if node.is_dir and not self._is_done('mkdir', node.relpath):
                 self.create_new(node, utime=False)
+                self._record_landed('mkdir', node.relpath)
+
+        self._sync_journal()
+
+        # Look up all of the block pointers that update_pair will want in one
+        # go, so that they are batched into as few zdb runs as possible.
+        if self.is_zfs:
+            to_check = [
+                (a, b) for a, b in pairs
+                if b.is_file and a.is_file
+                and b.size > self.block_check_size
+                and a.size == b.size
+                and a.ctime_ns != b.ctime_ns
+            ]
+            if to_check:
+                if proc.verbose:
+                    print(f"Looking up blocks for {len(to_check)} large files")
+                zdb.get_blocks(itertools.chain(
+                    ((self.src_snapshot_a.name, a.ino) for a, _ in to_check),
+                    ((self.src_snapshot_b.name, b.ino) for _, b in to_check),
+                ))
 
         work = []
 
         # Update files/links which exist in both.
         # This will be the secondary moves.
-        work.extend((self.update_pair, (a, b)) for a, b in pairs)
+        work.extend((self.run_item, (self.update_pair, a, b), self.estimate_cost(a, b)) for a, b in pairs)
 
         # Create new files/links that are in B but not A.
-        work.extend((self.create_new, (b, )) for b in b_by_rel.values() if not b.is_dir)
-
-        # For aesthetics, we do them in order.
+        work.extend((self.run_item, (self.create_new, b), self.estimate_cost(None, b)) for b in b_by_rel.values() if not b.is_dir)
+
+        # The rest of the hardlinks are done after, so pull them out (and
+        # note what that saved us).
+        if links:
+            saved_io = saved_space = 0
+            keep = []
+            for item in work:
+                b = item[1][-1]
+                if b.relpath in links:
+                    saved_io += item[2]
+                    saved_space += b.size
+                else:
+                    keep.append(item)
+            work = keep
+
+        # For aesthetics, we do them in order (within what the scheduler does).
         work.sort(key=lambda x: x[1][-1].path)
 
-        executor = futures.ThreadPoolExecutor(threads)
-        for _ in executor.map(lambda x: x[0](*x[1]), work):
-            pass
+        scheduler = Scheduler(
+            io_threads=threads,
+            meta_threads=threads,
+            max_bytes_in_flight=self.max_bytes_in_flight,
+        )
+        scheduler.run(work)
+
+        # Now that the first of each set of hardlinks is done, point the rest
+        # at it. If they already are (because A had the same links) then the
+        # update went to all of them already.
+        for relpath, primary in links.items():
+            ppath = os.path.join(self.target, primary.relpath)
+            tpath = os.path.join(self.target, relpath)
+            if not proc.dry_run:
+                try:
+                    if os.path.samefile(ppath, tpath):
+                        proc.count('link-skipped')
+                        continue
+                except FileNotFoundError:
+                    pass
+                if os.path.lexists(tpath):
+                    proc.unlink(tpath, verbosity=3)
+            proc.link(ppath, tpath)
+
+        if links:
+            print(f'Hardlinks: linked {len(links)} paths; saved {format_bytes(saved_io)} of I/O and {format_bytes(saved_space)} of space')
 
         # Cleanup the premove root.
-        if self._prename_count:
+        if self._prename_count and os.path.exists(self._prename_root):
             shutil.rmtree(self._prename_root)
 
         # Finally we set the mtimes of all directories.
-        # It might be marginally more efficient to track the changes we've
-        # made and not hit the filesystem for it. Oh well.
+        # Directories we haven't changed the entries of still have A's times,
+        # so we only need to touch those or the ones whose times differ. If we
+        # are resuming we don't know what the last run touched, so do them all.
         if not proc.dry_run:
             for b in bidx.nodes:
                 if b.is_dir:
                     tpath = os.path.join(self.target, b.relpath)
-                    st = os.stat(tpath)
-                    if (st.st_atime != b.stat.st_atime) or (st.st_mtime != b.stat.st_mtime):
-                        proc.utime(tpath, b.stat.st_atime, b.stat.st_mtime, verbosity=3)
+                    a = aidx.by_rel.get(b.relpath)
+                    if (
+                        self._resuming or tpath in proc.dirty_dirs
+                        or a is None or not a.is_dir
+                        or (a.atime_ns, a.mtime_ns) != (b.atime_ns, b.mtime_ns)
+                    ):
+                        proc.utime(tpath, b.atime_ns, b.mtime_ns, verbosity=3)
+                    else:
+                        proc.count('utime-skipped')
+
+        # Anything that was queued up goes now that nothing else will touch
+        # the directories.
+        if proc.batch_metadata:
+            count = proc.flush_metadata(threads)
+            if proc.verbose:
+                print(f"Applied {count} metadata changes")
+
+        # Items are only done once their metadata has landed.
+        if self._journal is not None:
+            for phase, key in self._journal_pending:
+                self._journal.record(phase, key)
+            self._journal_pending = []
+
+            # It must not end up in the snapshot.
+            self._journal.remove()
+            self._journal = None
+
+        self._aidx = None
+        self._setgid = {}
+
+        counts = proc.counts - counts_before
+        if counts:
+            print('Operations: ' + ', '.join(f'{k}={v}' for k, v in sorted(counts.items())))
+
+    def is_resumable(self):
+        # If A is the target then it changes under us, and so what we planned
+        # to do last time won't match what we would plan now.
+        return self.src_root_a != self.target
+
+    def can_resume(self):
+        return self.is_resumable() and Journal(self._journal_path, self.journal_header()).is_consistent()
+
+    def journal_header(self):
+        """What must be the same for a journal to be picked up again."""
+        return dict(
+            snapshot=self.dst_snapshot_name,
+            target=self.target,
+            src_root_a=self.src_root_a,
+            src_root_b=self.src_root_b,
+            guid_a=self.src_snapshot_a.guid if self.src_snapshot_a else None,
+            guid_b=self.src_snapshot_b.guid if self.src_snapshot_b else None,
+            ignore=sorted(self.ignore or ()),
+            use_diff=bool(self.is_zfs and self.use_diff),
+        )
+
+    def _is_done(self, phase, key):
+        return self._journal is not None and self._journal.is_done(phase, key)
+
+    def _record(self, phase, key):
+        if self._journal is not None:
+            self._journal.record(phase, key)
+
+    def _record_landed(self, phase, key):
+        # Batched metadata hasn't been applied yet, so anything with some
+        # isn't done until it has been flushed.
+        if self._proc.batch_metadata:
+            self._journal_pending.append((phase, key))
+        else:
+            self._record(phase, key)
+
+    def _sync_journal(self):
+        if self._journal is not None:
+            self._journal.sync()
+
+    def run_item(self, func, *args):
+        """Run update_pair/create_new, skipping it if the journal has it."""
+
+        b = args[-1]
+
+        if self._is_done('work', b.relpath):
+            if self.verify(b):
+                self._proc.count('resume-skipped')
+                return
+            self._proc.count('resume-redone')
+
+        func(*args)
+        self._record_landed('work', b.relpath)
+
+    def verify(self, b):
+        """If the target looks like it already has B in it."""
+        try:
+            st = os.lstat(os.path.join(self.target, b.relpath))
+        except FileNotFoundError:
+            return False
+        if stat.S_IFMT(st.st_mode) != b.fmt:
+            return False
+        if b.is_file and st.st_size != b.size:
+            return False
+        return True
+
+    def can_prefetch(self):
+        # Anything that looks at the target has to wait for the jobs before
+        # it to finish with it, as does anything that needs pre_bash first.
+        if self.pre_bash:
+            return False
+        for root in (self.src_root_a, self.src_root_b):
+            if root == self.target or root.startswith(self.target + '/') or self.target.startswith(root + '/'):
+                return False
+        return True
+
+    def prefetch(self):
+        return self.get_indexes()
+
+    def prepare(self):
+        # The runner may have already started on this while the last job ran.
+        if self._indexes is None:
+            if self._prefetched is not None:
+                self._indexes = self._prefetched.result()
+                self._prefetched = None
+            else:
+                self._indexes = self.get_indexes()
+        return self._indexes
+
+    def hand_off(self, other):
+
+        # In chains of jobs our B is the next one's A; since it is a source
+        # (and so doesn't change) it can have our index instead of walking
+        # it again. Diff indexes are partial, so they can't be.
+        if not isinstance(other, SyncJob) or self._indexes is None:
+            return
+        # Too late if it already has (or is getting) its own.
+        if other._index_a is not None or other._indexes is not None or other._prefetched is not None:
+            return
+        if (self.is_zfs and self.use_diff) or (other.is_zfs and other.use_diff):
+            return
+        if other.src_root_a != self.src_root_b or other.src_root_a == other.target:
+            return
+        if set(other.ignore or ()) != set(self.ignore or ()):
+            return
+
+        other._index_a = self._indexes[1]
+
+    def get_indexes(self):
+        if self.is_zfs and self.use_diff:
+            return self.get_diff_indexes()
+        if self._index_a is not None:
+            print(f'Reusing index of {self.src_root_a} from the last job')
+            aidx, self._index_a = self._index_a, None
+        else:
+            aidx = self.get_index(self.src_root_a, self.src_snapshot_a)
+        return (
+            aidx,
+            self.get_index(self.src_root_b, self.src_snapshot_b),
+        )
+
+    def get_index(self, root, snapshot):
+        # Snapshots are read-only, so their indexes can be reused; everything
+        # else (e.g. the target) must be indexed fresh.
+        return Index.get(root,
+            ignore=self.ignore,
+            guid=snapshot.guid if snapshot else None,
+            cache=bool(snapshot) and root != self.target,
+        )
+
+    def get_diff_indexes(self):
+        """Get partial indexes of A and B with only what `zfs diff` says changed.
+
+        Everything else is assumed to already be correct in the target, so
+        the rest of the replay treats these as if they were the full indexes.
+
+        """
+
+        snap_a = self.src_snapshot_a
+        snap_b = self.src_snapshot_b
+
+        # The diff is of the whole volume, but we may only be replaying a
+        # subdirectory of it.
+        subdir = os.path.relpath(self.src_root_b, snap_b.root)
+        prefix = '' if subdir == '.' else subdir + '/'
+
+        # relpath -> if we need everything under it as well.
+        paths = {}
+
+        def add(relpath, recurse=False):
+
+            if prefix:
+                if not relpath.startswith(prefix):
+                    return
+                relpath = relpath[len(prefix):]
+            if not relpath:
+                return
+            if self.ignore and relpath.split('/', 1)[0] in self.ignore:
+                return
+
+            paths[relpath] = paths.get(relpath) or recurse
+
+            # Parents will need their times fixed (and must be paired up so
+            # they aren't considered new).
+            while '/' in relpath:
+                relpath = relpath.rsplit('/', 1)[0]
+                paths.setdefault(relpath, False)
+
+        print(f'Diffing {snap_a.name} to {snap_b.name}')
+
+        num_items = 0
+        batches = diff.iter_diff_batches(snap_a.volume, snap_a.snapname, snap_b.snapname, subdir=prefix)
+        for batch in batches:
+
+            num_items += len(batch.ops)
+
+            for type_, op, relpath, new_relpath in zip(batch.types, batch.ops, batch.relpaths, batch.new_relpaths):
+
+                # Directories which are created/removed/renamed bring everything
+                # under them along; zfs diff won't necessarily list their contents.
+                recurse = type_ == diff.TYPE_DIR and op != diff.OP_MODIFY
+
+                add(relpath, recurse)
+                if op == diff.OP_RENAME:
+                    add(new_relpath, recurse)
+
+        aidx = Index(self.src_root_a, set(self.ignore or ()))
+        bidx = Index(self.src_root_b, set(self.ignore or ()))
+
+        # Sorted so that parents come before their children.
+        for idx in (aidx, bidx):
+            idx.prime()
+            for relpath, recurse in sorted(paths.items()):
+                idx.add_path(relpath, recurse)
+
+        print(f'    {num_items} changes touched {len(aidx.by_rel)} paths in A and {len(bidx.by_rel)} in B')
+
+        return aidx, bidx
+
+    def get_links(self, aidx, bidx, pairs):
+        """Figure out the hardlinks in B, and which in A can't be written to.
+
+        Returns a dict of relpath of each hardlink to the node in B that it
+        should be a link to. Any A paths which are links that don't survive
+        as the same set in B are noted so update_pair doesn't write through
+        them into the other links.
+
+        """
+
+        links = {}
+        for bnodes in bidx.by_ino.values():
+            if len(bnodes) > 1 and bnodes[0].is_file:
+                for b in bnodes[1:]:
+                    links[b.relpath] = bnodes[0]
+
+        self._break_links = set()
+
+        b_by_arel = {a.relpath: b for a, b in pairs}
+        for anodes in aidx.by_ino.values():
+            if len(anodes) < 2 or not anodes[0].is_file:
+                continue
+            arels = set(a.relpath for a in anodes)
+            bnodes = [b_by_arel.get(relpath) for relpath in arels]
+            if not any(bnodes):
+                continue
+            if None not in bnodes:
+                inodes = set(b.ino for b in bnodes)
+                if len(inodes) == 1 and len(bidx.by_ino[inodes.pop()]) == len(bnodes):
+                    continue
+            self._break_links.update(arels)
+
+        return links
+
+    def estimate_cost(self, a, b):
+        """Roughly how many bytes update_pair/create_new will have to move."""
+
+        if not b.is_file:
+            return 0
+        if a is None:
+            return b.size
+
+        # These mirror the shortcuts in update_pair.
+        if (not self.is_zfs) and a.ino == b.ino:
+            return 0
+        if self.is_zfs and a.ctime_ns == b.ctime_ns:
+            return 0
+        if a.size == b.size and a.mtime_ns == b.mtime_ns and a.ctime_ns == b.ctime_ns:
+            return 0
+
+        return b.size
 
     def update_pair(self, a, b):
 
@@ -294,28 +735,51 @@ class SyncJob(Job):
             if a.is_dir:
                 raise ValueError(f"Directory appears to move: {a.relpath} to {b.relpath}")
 
-            proc.rename(b.prename_path, tpath, original=a.relpath)
+            # If we are resuming, this may have been the part we got to.
+            if not (self._resuming and not os.path.lexists(b.prename_path)):
+                proc.rename(b.prename_path, tpath, original=a.relpath)
 
         # If this is not ZFS, hardlinks can't have different (meta)data.
         if (not self.is_zfs) and a.ino == b.ino:
             return
 
         # If this is ZFS, files with same ctime can't have been modified.
-        if self.is_zfs and a.stat.st_ctime == b.stat.st_ctime:
+        if self.is_zfs and a.ctime_ns == b.ctime_ns:
             return
 
+        # If the target is a hardlink that won't be in B, then writing to it
+        # would also write to the others; start this one from scratch.
+        if a.relpath in self._break_links and b.is_file:
+            if not (self._resuming and not os.path.lexists(tpath)):
+                proc.unlink(tpath, verbosity=3)
+            self.create_new(b)
+            return
+
+        # Otherwise, the same size and times are as good as we can tell without
+        # reading them (now that the times are exact).
+        same_data = a.size == b.size and a.mtime_ns == b.mtime_ns and a.ctime_ns == b.ctime_ns
+
+        # If we touched the data; the times will need resetting if so.
+        written = False
+
         if b.is_dir:
             # We're not doing anything; this is just for control flow.
             pass
 
         elif b.is_link:
             if a.link_dest != b.link_dest:
-                proc.unlink(tpath, verbosity=3)
+                if not (self._resuming and not os.path.lexists(tpath)):
+                    proc.unlink(tpath, verbosity=3)
                 proc.symlink(b.link_dest, tpath)
+                written = True
+
+        elif same_data:
+            proc.count('merge-skipped')
 
         # If they're different sizes, lets just assume they are different.
-        elif a.stat.st_size != b.stat.st_size:
-            proc.copy(bpath, tpath)
+        elif a.size != b.size:
+            proc.copy(bpath, tpath, new=False)
+            written = True
 
         # Try to efficiently update them.
         else:
@@ -323,7 +787,7 @@ class SyncJob(Job):
             # Check what block they are stored in. If it did not change,
             # then the file did not change.
             nochange = False
-            if self.is_zfs and b.stat.st_size > (1024 * 1024 * 50):
+            if self.is_zfs and b.size > self.block_check_size:
                 ablock = zdb.get_block(self.src_snapshot_a.name, a.ino)
                 bblock = zdb.get_block(self.src_snapshot_b.name, b.ino)
                 if ablock and ablock == bblock:
@@ -331,17 +795,48 @@ class SyncJob(Job):
                     if proc.verbose:
                         print(f'{"nochange":10}', tpath)
             
+            if not nochange and self.is_zfs and self.block_merge and b.size > self.block_check_size:
+                nochange = written = self.merge_blocks(a, b, tpath)
+
             if not nochange:
+                # Even if nothing differed we read it, which may touch atime.
                 proc.merge(bpath, tpath)
+                written = True
 
         # Metadata!
-        if a.stat.st_mode != b.stat.st_mode:
-            proc.chmod(tpath, b.stat.st_mode)
-        if (a.stat.st_uid != b.stat.st_uid) or (a.stat.st_gid != b.stat.st_gid):
-            proc.chown(tpath, b.stat.st_uid, b.stat.st_gid)
+        if a.mode != b.mode:
+            proc.chmod(tpath, b.mode)
+        if (a.uid != b.uid) or (a.gid != b.gid):
+            proc.chown(tpath, b.uid, b.gid)
+
+        # Times will almost always need to be set at this point, but the
+        # target still has A's times if we didn't touch it.
+        if written or (a.atime_ns, a.mtime_ns) != (b.atime_ns, b.mtime_ns):
+            proc.utime(tpath, b.atime_ns, b.mtime_ns, verbosity=3)
+        else:
+            proc.count('utime-skipped')
+
+    def merge_blocks(self, a, b, tpath):
+        """Write only the blocks of B whose pointers differ from A.
+
+        Returns if it was able to; otherwise a normal merge is needed.
+
+        """
 
-        # Times will almost always need to be set at this point.
-        proc.utime(tpath, b.stat.st_atime, b.stat.st_mtime, verbosity=3)
+        amap = zdb.get_block_map(self.src_snapshot_a.name, a.ino)
+        bmap = zdb.get_block_map(self.src_snapshot_b.name, b.ino)
+        if not (amap and bmap and amap.block_size and amap.block_size == bmap.block_size):
+            return False
+
+        # Blocks which have become holes in B are missing from its map, so
+        # they show up here as well (and we copy the zeros).
+        offsets = [
+            offset for offset in set(amap.blocks).union(bmap.blocks)
+            if amap.blocks.get(offset) != bmap.blocks.get(offset)
+        ]
+
+        self._proc.merge_blocks(b.path, tpath, offsets, bmap.block_size)
+        return True
 
     def create_new(self, b, utime=True):
 
@@ -350,8 +845,16 @@ class SyncJob(Job):
         bpath = b.path
         tpath = os.path.join(self.target, b.relpath)
 
+        # If we are resuming, this may have been the part we got to.
+        if self._resuming and os.path.lexists(tpath):
+            if not b.is_dir:
+                proc.unlink(tpath, verbosity=3)
+            elif not os.path.isdir(tpath):
+                raise ValueError(f"Expected a directory at {tpath}")
+
         if b.is_dir:
-            proc.mkdir(tpath)
+            if not (self._resuming and os.path.isdir(tpath)):
+                proc.mkdir(tpath)
 
         elif b.is_link:
             proc.symlink(b.link_dest, tpath)
@@ -359,15 +862,54 @@ class SyncJob(Job):
         else:
             proc.copy(bpath, tpath)
 
+        # New things are owned by us, unless the parent is setgid (in which
+        # case they get the parent's group, and directories get setgid too).
+        setgid = self._may_be_setgid(b.parent)
+
         if not b.is_link:
             # We just don't have the capability in our Python for some reason,
             # even though it should be availible.
-            proc.chmod(tpath, b.stat.st_mode, verbosity=3)
+            # New things are made with the default mode (via our umask).
+            if b.is_dir:
+                current = None if setgid else DEFAULT_DIR_MODE
+            else:
+                current = DEFAULT_FILE_MODE
+            proc.chmod(tpath, b.mode, verbosity=3, current=current)
 
-        proc.chown(tpath, b.stat.st_uid, b.stat.st_gid, verbosity=3)
+        if b.uid != self._euid or b.gid != self._egid or setgid:
+            proc.chown(tpath, b.uid, b.gid, verbosity=3)
+        else:
+            proc.count('chown-skipped')
         
         if utime:
-            proc.utime(tpath, b.stat.st_atime, b.stat.st_mtime, verbosity=3)
+            proc.utime(tpath, b.atime_ns, b.mtime_ns, verbosity=3)
+
+    def _may_be_setgid(self, node):
+        """If the target's directory for this (B) one may be setgid while we
+        are creating things in it.
+
+        It starts with A's mode (if it was in A) and is being changed to B's
+        at the same time (or later, if batched), so it may be either; ones
+        we create inherit it from their parent until then. ``None`` is the
+        target itself.
+
+        """
+
+        if node is None:
+            return self._target_setgid
+
+        relpath = node.relpath
+        setgid = self._setgid.get(relpath)
+        if setgid is None:
+            setgid = bool(node.mode & stat.S_ISGID)
+            a = self._aidx.by_rel.get(relpath)
+            if a is not None and a.is_dir:
+                setgid = setgid or bool(a.mode & stat.S_ISGID)
+            else:
+                setgid = setgid or self._may_be_setgid(node.parent)
+            self._setgid[relpath] = setgid
+
+        return setgid
 
 
 
@@ -466,6 +1008,17 @@ def main():
     parser.add_argument('-a', '--all', action='store_true')
     parser.add_argument('-n', '--dry-run', action='count', default=0)
     parser.add_argument('-t', '--threads', type=int, default=4)
+    parser.add_argument('-T', '--index-threads', type=int, default=8)
+    parser.add_argument('--cache-root')
+    parser.add_argument('-D', '--zfs-diff', action='store_true')
+    parser.add_argument('--block-check-mb', type=int, default=50)
+    parser.add_argument('-B', '--block-merge', action='store_true')
+    parser.add_argument('--max-inflight-mb', type=int, default=1024)
+    parser.add_argument('-M', '--batch-metadata', action='store_true')
+    parser.add_argument('--no-resume', action='store_true')
+    parser.add_argument('--no-prefetch', action='store_true')
+    parser.add_argument('--index-memory-mb', type=int, default=4096)
+    parser.add_argument('--diff-cache-gb', type=int, default=10)
     parser.add_argument('-v', '--verbose', action='count', default=0)
     parser.add_argument('-c', '--count', type=int, default=0)
     parser.add_argument('sets', nargs='*')
@@ -479,6 +1032,16 @@ def main():
         print("Provide a set name.")
         exit(1)
 
+    Index.threads = args.index_threads
+    Index.cache_bytes = args.index_memory_mb * 1024 * 1024
+    diff.CACHE_BYTES = args.diff_cache_gb * 1024 * 1024 * 1024
+    SyncJob.use_diff = args.zfs_diff
+    SyncJob.block_check_size = args.block_check_mb * 1024 * 1024
+    SyncJob.block_merge = args.block_merge
+    SyncJob.max_bytes_in_flight = args.max_inflight_mb * 1024 * 1024
+    if args.cache_root:
+        utils.CACHE_ROOT = args.cache_root
+
     for set_ in args.sets:
         do_set(args, set_)
 
@@ -555,20 +1118,42 @@ def do_set(args, set_):
 
     existing_snapshots = get_snapshots(jobs[0].dst_volume)
 
-    # Start with a clean slate.
-    cmd = ['zfs', 'rollback', existing_snapshots[-1].name]
-    if args.verbose > 1:
-        print('$', ' '.join(cmd))
-    if not args.dry_run:
-        subprocess.check_call(cmd)
+    # Start with a clean slate, unless the next job left a journal of where it
+    # got to, in which case it can pick up from there.
+    existing_names = set(s.snapname for s in existing_snapshots)
+    next_job = next((j for j in jobs if j.dst_snapname not in existing_names), None)
+    if next_job and not args.no_resume and next_job.can_resume():
+        click.secho(f'Will resume {next_job.dst_snapshot_name} instead of rolling back', fg='yellow')
+    else:
+        cmd = ['zfs', 'rollback', existing_snapshots[-1].name]
+        if args.verbose > 1:
+            print('$', ' '.join(cmd))
+        if not args.dry_run:
+            subprocess.check_call(cmd)
 
     processor = Processor(
         dry_run=args.dry_run,
         verbose=args.verbose,
+        batch_metadata=args.batch_metadata,
     )
 
+    # The next job's indexes (or diff) are done in the background while the
+    # current one is being applied; only the jobs which don't look at the
+    # target can be, so the target and snapshots still go strictly in order.
+    prefetcher = futures.ThreadPoolExecutor(1)
+    try:
+        _run_jobs(args, processor, existing_snapshots, prefetcher)
+    finally:
+        prefetcher.shutdown(wait=False, cancel_futures=True)
+
+
+def _run_jobs(args, processor, existing_snapshots, prefetcher):
+
     done = 0
 
+    existing_names = set(s.snapname for s in existing_snapshots)
+    todo = [j for j in jobs if j.dst_snapname not in existing_names]
+
     for job in jobs:
 
         existing = next((s for s in existing_snapshots if s.snapname == job.dst_snapname), None)
@@ -588,11 +1173,30 @@ def do_set(args, set_):
         if existing:
             continue
 
+        i = todo.index(job)
+        next_job = todo[i + 1] if i + 1 < len(todo) else None
+
         start_time = dt.datetime.utcnow()
         if args.dry_run < 2:
             click.echo('---')
             try:
-                job.run(processor, threads=args.threads)
+
+                # Get our indexes first, so the next job can have any it can
+                # reuse before it starts on its own. Only if we could have
+                # prefetched them though; anything that needs pre_bash or
+                # looks at the target has to wait for run, which hands off
+                # once it has them (unless the next is prefetching already).
+                if job.can_prefetch():
+                    job.prepare()
+                    job.hand_off(next_job)
+
+                if (
+                    next_job and not args.no_prefetch
+                    and next_job.can_prefetch() and next_job._prefetched is None
+                ):
+                    next_job._prefetched = prefetcher.submit(next_job.prefetch)
+
+                job.run(processor, threads=args.threads, next_job=next_job)
             except Exception as e:
                 click.secho(f'{e.__class__.__name__}: {e}', fg='red')
                 pdb.post_mortem()
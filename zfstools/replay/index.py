@@ -1,19 +1,117 @@
+from concurrent import futures
+import array
 import collections
+import collections.abc
+import hashlib
+import mmap
 import os
+import random
 import stat
+import struct
+import sys
+import threading
 import time
 
-from ..utils import cached_property
+from ..utils import cached_property, format_bytes, get_cache_dir
 
 
-BaseNode = collections.namedtuple('BaseNode', 'name path relpath ino fmt is_dir is_file is_link stat')
+# Raw results of walking a tree; these are folded into the Index's columns.
+Entry = collections.namedtuple('Entry', 'name path relpath ino fmt is_dir is_file is_link stat')
 
-class Node(BaseNode):
 
-    @cached_property
-    def link_dest(self):
-        return os.readlink(self.path)
+def _ns_to_float(ns):
+    # The same way that CPython builds st_*time from the timespec.
+    sec, nsec = divmod(ns, 1000000000)
+    return sec + nsec * 1e-9
+
+
+class Node(object):
+    """A lightweight view of a single entry within an :class:`Index`."""
+
+    __slots__ = ('index', 'id', 'prename_path', '_link_dest')
+
+    def __init__(self, index, id_):
+        self.index = index
+        self.id = id_
+
+    def __repr__(self):
+        return f'Node({self.path!r}, ino={self.ino}, mode={self.mode:o})'
+
+    def __eq__(self, other):
+        return isinstance(other, Node) and self.index is other.index and self.id == other.id
+
+    def __hash__(self):
+        return hash((id(self.index), self.id))
+
+    @property
+    def relpath(self):
+        return self.index.relpaths[self.id]
+
+    @property
+    def name(self):
+        return self.relpath.rpartition('/')[2]
+
+    @property
+    def path(self):
+        return os.path.join(self.index.root, self.relpath)
+
+    @property
+    def parent(self):
+        id_ = self.index.parent[self.id]
+        return None if id_ < 0 else Node(self.index, id_)
 
+    ino = property(lambda self: self.index.ino[self.id])
+    nlink = property(lambda self: self.index.nlink[self.id])
+    size = property(lambda self: self.index.size[self.id])
+    atime_ns = property(lambda self: self.index.atime_ns[self.id])
+    mtime_ns = property(lambda self: self.index.mtime_ns[self.id])
+    ctime_ns = property(lambda self: self.index.ctime_ns[self.id])
+    mode = property(lambda self: self.index.mode[self.id])
+    uid = property(lambda self: self.index.uid[self.id])
+    gid = property(lambda self: self.index.gid[self.id])
+
+    @property
+    def fmt(self):
+        return stat.S_IFMT(self.mode)
+
+    @property
+    def is_dir(self):
+        return self.fmt == stat.S_IFDIR
+
+    @property
+    def is_file(self):
+        return self.fmt == stat.S_IFREG
+
+    @property
+    def is_link(self):
+        return self.fmt == stat.S_IFLNK
+
+    @property
+    def stat(self):
+        idx = self.index
+        i = self.id
+        atime_ns = idx.atime_ns[i]
+        mtime_ns = idx.mtime_ns[i]
+        ctime_ns = idx.ctime_ns[i]
+        return os.stat_result((
+            idx.mode[i], idx.ino[i], idx.dev, idx.nlink[i], idx.uid[i], idx.gid[i], idx.size[i],
+            atime_ns // 1000000000, mtime_ns // 1000000000, ctime_ns // 1000000000,
+        ), dict(
+            st_atime=_ns_to_float(atime_ns),
+            st_mtime=_ns_to_float(mtime_ns),
+            st_ctime=_ns_to_float(ctime_ns),
+            st_atime_ns=atime_ns,
+            st_mtime_ns=mtime_ns,
+            st_ctime_ns=ctime_ns,
+        ))
+
+    @property
+    def link_dest(self):
+        try:
+            return self._link_dest
+        except AttributeError:
+            self._link_dest = value = os.readlink(self.path)
+            return value
 
 
 def walk(root, ignore=None, rel_root=None, root_dev=None, _depth=0):
@@ -53,49 +151,428 @@ def walk(root, ignore=None, rel_root=None, root_dev=None, _depth=0):
         if not (is_dir or is_file or is_link):
             continue
 
-        yield Node(name, path, os.path.relpath(path, rel_root), st.st_ino, fmt, is_dir, is_file, is_link, st)
+        yield Entry(name, path, os.path.relpath(path, rel_root), st.st_ino, fmt, is_dir, is_file, is_link, st)
 
         if is_dir:
             yield from walk(path, rel_root=rel_root, root_dev=root_dev, _depth=_depth+1)
 
 
+def _make_entry(name, path, relpath, st, root_dev):
+
+    if st.st_dev != root_dev:
+        return
+
+    fmt = stat.S_IFMT(st.st_mode)
+    is_dir = fmt == stat.S_IFDIR
+    is_file = fmt == stat.S_IFREG
+    is_link = fmt == stat.S_IFLNK
+    if not (is_dir or is_file or is_link):
+        return
+
+    return Entry(name, path, relpath, st.st_ino, fmt, is_dir, is_file, is_link, st)
+
+
+def _scan(path, relpath, root_dev, ignore=None):
+
+    nodes = []
+
+    with os.scandir(path) as it:
+        for entry in it:
+
+            name = entry.name
+            if ignore and name in ignore:
+                continue
+
+            st = entry.stat(follow_symlinks=False)
+            node = _make_entry(name, entry.path, os.path.join(relpath, name) if relpath else name, st, root_dev)
+            if node:
+                nodes.append(node)
+
+    nodes.sort(key=lambda n: n.name)
+    return nodes
+
+
+def walk_parallel(root, ignore=None, threads=8):
+    """Like :func:`walk`, but directories are scanned by a pool of threads.
+
+    Every directory is submitted to the pool as soon as its parent has been
+    scanned, and we consume the results in the same order that :func:`walk`
+    would yield them.
+
+    """
+
+    # Prime ZFS; see walk.
+    os.listdir(root)
+    os.listdir(root)
+    root_dev = os.stat(root).st_dev
+
+    executor = futures.ThreadPoolExecutor(threads)
+    pending = {}
+
+    def scan(path, relpath, ignore=None):
+        nodes = _scan(path, relpath, root_dev, ignore)
+        for node in nodes:
+            if node.is_dir:
+                pending[node.path] = executor.submit(scan, node.path, node.relpath)
+        return nodes
+
+    def emit(nodes):
+        for node in nodes:
+            yield node
+            if node.is_dir:
+                yield from emit(pending.pop(node.path).result())
+
+    try:
+        yield from emit(scan(root, '', ignore))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+# On-disk format; see Index.dump. The 8-byte columns come first so that
+# everything stays aligned for the memoryview casts.
+_MAGIC = b'ZRIDX02\n'
+_HEADER = struct.Struct('<8sQQQ') # magic, count, dev, paths_size
+_COLUMNS = (
+    ('ino', 'Q'),
+    ('nlink', 'Q'),
+    ('size', 'q'),
+    ('atime_ns', 'q'),
+    ('mtime_ns', 'q'),
+    ('ctime_ns', 'q'),
+    ('parent', 'q'),
+    ('mode', 'I'),
+    ('uid', 'I'),
+    ('gid', 'I'),
+)
+
+
+class NodeList(collections.abc.Sequence):
+
+    def __init__(self, index):
+        self._index = index
+
+    def __len__(self):
+        return len(self._index.relpaths)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [Node(self._index, x) for x in range(len(self))[i]]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return Node(self._index, i)
+
+
+class NodeMap(collections.abc.MutableMapping):
+    """A mapping to node ids which presents them as :class:`Node` views.
+
+    With ``multi``, values are either a single id or a list of them, and are
+    always returned as a list of nodes.
+
+    """
+
+    def __init__(self, index, ids, multi=False):
+        self._index = index
+        self._ids = ids
+        self._multi = multi
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __contains__(self, key):
+        return key in self._ids
+
+    def __getitem__(self, key):
+        value = self._ids[key]
+        if not self._multi:
+            return Node(self._index, value)
+        if isinstance(value, list):
+            return [Node(self._index, x) for x in value]
+        return [Node(self._index, value)]
+
+    def __setitem__(self, key, value):
+        if self._multi:
+            if any(node.index is not self._index for node in value):
+                raise ValueError("Node is from another index.")
+            self._ids[key] = [node.id for node in value]
+        else:
+            if value.index is not self._index:
+                raise ValueError("Node is from another index.")
+            self._ids[key] = value.id
+
+    def __delitem__(self, key):
+        del self._ids[key]
+
+    def copy(self):
+        return self.__class__(self._index, self._ids.copy(), self._multi)
+
+
 class Index(object):
 
-    _cache = {}
+    _cache = collections.OrderedDict()
+    _cache_lock = threading.Lock()
+
+    # How many (read-only) indexes to keep in memory, and roughly how much
+    # memory they may take between them (the most recent is always kept).
+    cache_size = 4
+    cache_bytes = 4 * 1024 * 1024 * 1024
+
+    # How many threads to walk with; 1 uses the plain recursive walk.
+    threads = 1
 
     @classmethod
-    def get(cls, root, ignore=None, cache_key=None):
+    def get(cls, root, ignore=None, cache_key=None, threads=None, guid=None, cache=None):
+        """Get an index of the given root.
+
+        :param guid: The GUID of the ZFS snapshot the root is within; if given
+            the index is persisted to disk for the next time we are asked.
+        :param bool cache: If the root is read-only and so can be kept around
+            in memory; defaults to if we were given a GUID.
+
+        """
 
         ignore = set(ignore or ())
-        cache_key = cache_key or (root, tuple(ignore))
+        cache_key = cache_key or (root, tuple(sorted(ignore)))
+        cache = bool(guid) if cache is None else cache
 
-        try:
-            pass #return cls._cache[cache_key]
-        except KeyError:
-            pass
+        if cache:
+            with cls._cache_lock:
+                self = cls._cache.get(cache_key)
+                if self is not None:
+                    cls._cache.move_to_end(cache_key)
+                    print(f'Reusing index of {root}')
+                    return self
 
-        print(f'Indexing {root}\n    ignoring {ignore or None}')
+        disk_path = cls.get_disk_path(guid, root, ignore) if guid else None
+        if disk_path and os.path.exists(disk_path):
+
+            print(f'Loading index of {root}\n    from {disk_path}')
+            self = cls.load(disk_path, root, ignore)
+
+        else:
+
+            print(f'Indexing {root}\n    ignoring {ignore or None}')
+            self = cls(root, ignore)
+            self.go(threads or cls.threads)
+
+            if disk_path:
+                self.dump(disk_path)
 
-        self = cls(root, ignore)
-        self.go()
-        #cls._cache[cache_key] = self
-        
         print(f'    {len(self.by_ino)} inodes in {len(self.by_rel)} paths')
 
+        if cache:
+            with cls._cache_lock:
+                cls._cache[cache_key] = self
+                total = sum(x.nbytes for x in cls._cache.values())
+                while len(cls._cache) > 1 and (len(cls._cache) > cls.cache_size or total > cls.cache_bytes):
+                    _, old = cls._cache.popitem(last=False)
+                    total -= old.nbytes
+
         return self
 
+    @cached_property
+    def nbytes(self):
+        """Roughly how much memory this takes; only valid once it is built."""
+        size = sum(getattr(self, name).itemsize * len(getattr(self, name)) for name, _ in _COLUMNS)
+        size += sys.getsizeof(self.relpaths) + sum(sys.getsizeof(x) for x in self.relpaths)
+        size += sys.getsizeof(self._by_rel) + sys.getsizeof(self._by_ino)
+        return size
+
+    @staticmethod
+    def get_disk_path(guid, root, ignore):
+        # The root is within the snapshot, so we need to key on that too.
+        key = hashlib.sha1(repr((root, sorted(ignore))).encode()).hexdigest()[:16]
+        return os.path.join(get_cache_dir('index'), f'{guid}.{key}.idx')
+
     def __init__(self, root, ignore):
+
         self.root = root
         self.ignore = ignore
-        self.nodes = []
-        self.by_ino = {}
-        self.by_rel = {}
+        self.dev = 0
+
+        # The relpaths double as our path table and the keys of by_rel; the
+        # rest of the stat is held in parallel columns indexed by node id.
+        self.relpaths = []
+        for name, code in _COLUMNS:
+            setattr(self, name, array.array(code))
+
+        self._by_rel = {}
+        self._by_ino = {}
+
+        self.nodes = NodeList(self)
+        self.by_rel = NodeMap(self, self._by_rel)
+        self.by_ino = NodeMap(self, self._by_ino, multi=True)
+
+    def go(self, threads=1):
+        if threads > 1:
+            entries = walk_parallel(self.root, ignore=self.ignore, threads=threads)
+        else:
+            entries = walk(self.root, ignore=self.ignore)
+        for entry in entries:
+            self.add(entry)
+
+    def prime(self):
+        # See walk for why we list twice.
+        os.listdir(self.root)
+        os.listdir(self.root)
+        self.dev = os.stat(self.root).st_dev
+
+    def add_path(self, relpath, recurse=False):
+        """Add a single path (and optionally everything under it).
+
+        This is for building partial indexes of only what we know has changed;
+        call :meth:`prime` first. Missing paths are quietly skipped.
+
+        """
+
+        if relpath not in self._by_rel:
+
+            path = os.path.join(self.root, relpath)
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                return
+
+            entry = _make_entry(os.path.basename(relpath), path, relpath, st, self.dev)
+            if not entry:
+                return
+            self.add(entry)
+
+        if recurse and self.by_rel[relpath].is_dir:
+            path = os.path.join(self.root, relpath)
+            for entry in walk(path, rel_root=self.root, root_dev=self.dev, _depth=1):
+                if entry.relpath not in self._by_rel:
+                    self.add(entry)
+
+    def add(self, entry):
+
+        st = entry.stat
+        relpath = entry.relpath
+        id_ = len(self.relpaths)
+
+        self.dev = st.st_dev
+        self.relpaths.append(relpath)
+        self.ino.append(st.st_ino)
+        self.nlink.append(st.st_nlink)
+        self.size.append(st.st_size)
+        self.atime_ns.append(st.st_atime_ns)
+        self.mtime_ns.append(st.st_mtime_ns)
+        self.ctime_ns.append(st.st_ctime_ns)
+        self.parent.append(self._by_rel.get(relpath.rpartition('/')[0], -1))
+        self.mode.append(st.st_mode)
+        self.uid.append(st.st_uid)
+        self.gid.append(st.st_gid)
+
+        self._index_id(id_)
+
+    def _index_id(self, id_):
+        self._by_rel[self.relpaths[id_]] = id_
+        # Most inodes only have the one path, so we don't bother with a list
+        # until there are hardlinks.
+        ino = self.ino[id_]
+        existing = self._by_ino.get(ino)
+        if existing is None:
+            self._by_ino[ino] = id_
+        elif isinstance(existing, list):
+            existing.append(id_)
+        else:
+            self._by_ino[ino] = [existing, id_]
+
+    def dump(self, path):
+
+        paths = b'\0'.join(os.fsencode(x) for x in self.relpaths)
+
+        tmp_path = f'{path}.{random.random()}'
+        with open(tmp_path, 'wb') as fh:
+            fh.write(_HEADER.pack(_MAGIC, len(self.relpaths), self.dev, len(paths)))
+            for name, _ in _COLUMNS:
+                fh.write(getattr(self, name))
+            fh.write(paths)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, root, ignore):
+
+        with open(path, 'rb') as fh:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
 
-    def go(self):
-        for node in walk(self.root, ignore=self.ignore):
-            self.nodes.append(node)
-            self.by_ino.setdefault(node.ino, []).append(node)
-            self.by_rel[node.relpath] = node
+        magic, count, dev, paths_size = _HEADER.unpack_from(mm)
+        if magic != _MAGIC:
+            raise ValueError(f"Bad index magic in {path}: {magic!r}")
+
+        self = cls(root, ignore)
+        self.dev = dev
+
+        # The columns are read-only views straight into the page cache.
+        view = memoryview(mm)
+        offset = _HEADER.size
+        for name, code in _COLUMNS:
+            size = count * struct.calcsize(code)
+            setattr(self, name, view[offset:offset + size].cast(code))
+            offset += size
+
+        if count:
+            self.relpaths = [os.fsdecode(x) for x in bytes(view[offset:offset + paths_size]).split(b'\0')]
+
+        for id_ in range(count):
+            self._index_id(id_)
+
+        return self
+
+
+def make_synthetic_tree(root, count, per_dir=1000):
+    """Create ``count`` empty files under ``root``, ``per_dir`` per directory."""
+    for i in range(count):
+        dir_ = os.path.join(root, f'{i // per_dir // per_dir:03d}', f'{i // per_dir % per_dir:03d}')
+        if not i % per_dir:
+            os.makedirs(dir_, exist_ok=True)
+        with open(os.path.join(dir_, f'{i:08d}'), 'wb'):
+            pass
+
+
+def measure_memory(root, ignore=None, threads=1):
+    """Compare the memory of an :class:`Index` to holding the raw entries.
+
+    The latter is how indexes used to be stored: a list of entries each with
+    its own paths and full stat, and dicts of them by inode and relpath.
+
+    """
+
+    import gc
+    import tracemalloc
+
+    def measure(func):
+        gc.collect()
+        tracemalloc.start()
+        value = func()
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return value, size
+
+    def build_old():
+        nodes = []
+        by_ino = {}
+        by_rel = {}
+        for entry in walk(root, ignore=ignore):
+            nodes.append(entry)
+            by_ino.setdefault(entry.ino, []).append(entry)
+            by_rel[entry.relpath] = entry
+        return nodes, by_ino, by_rel
+
+    def build_new():
+        idx = Index(root, set(ignore or ()))
+        idx.go(threads)
+        return idx
+
+    (nodes, _, _), old_size = measure(build_old)
+    idx, new_size = measure(build_new)
+
+    return len(nodes), old_size, new_size, idx.nbytes
 
 
 if __name__ == '__main__':
@@ -104,13 +581,42 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--ignore', action='append')
+    parser.add_argument('-t', '--threads', type=int, default=1)
+    parser.add_argument('--synthetic', type=int, metavar='COUNT',
+        help="Populate the (empty) root with a synthetic tree of this many files first.")
+    parser.add_argument('--bench', action='store_true',
+        help="Time the serial walk against the parallel walk.")
+    parser.add_argument('--memory', action='store_true',
+        help="Compare memory usage to holding a full stat per node.")
     parser.add_argument('roots', nargs='+')
     args = parser.parse_args()
 
     for root in args.roots:
 
         print(root)
-        idx = Index.get(root, ignore=args.ignore)
+
+        if args.synthetic:
+            start = time.monotonic()
+            make_synthetic_tree(root, args.synthetic)
+            print(f'    created {args.synthetic} files in {time.monotonic() - start:.2f}s')
+
+        if args.bench:
+            for threads in sorted(set((1, args.threads))):
+                start = time.monotonic()
+                idx = Index(root, set(args.ignore or ()))
+                idx.go(threads)
+                print(f'    {threads:2d} threads: {len(idx.nodes)} nodes in {time.monotonic() - start:.2f}s')
+            continue
+
+        if args.memory:
+            count, old_size, new_size, estimate = measure_memory(root, args.ignore, args.threads)
+            print(f'    {count} nodes')
+            print(f'    entries: {format_bytes(old_size):>10s} ({old_size / (count or 1):.0f}B per node)')
+            print(f'    columns: {format_bytes(new_size):>10s} ({new_size / (count or 1):.0f}B per node)')
+            print(f'    estimate: {format_bytes(estimate):>9s}')
+            continue
+
+        idx = Index.get(root, ignore=args.ignore, threads=args.threads)
 
         n_ino = len(idx.by_ino)
         n_rel = len(idx.by_rel)
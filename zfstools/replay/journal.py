@@ -0,0 +1,98 @@
+import json
+import os
+import threading
+import time
+
+
+class Journal(object):
+    """A write-ahead log of what parts of a job have been applied.
+
+    The first line is a JSON header describing the job; if it doesn't match
+    when we come back then the journal is not consistent with what we are
+    about to do. Every other line is a JSON ``[phase, key]`` (since keys are
+    paths, which can have newlines in them). A partial last line (from a
+    crash mid-write) is ignored; anything else we can't read makes the whole
+    thing inconsistent.
+
+    """
+
+    def __init__(self, path, header, sync_interval=5.0):
+        self.path = path
+        self.header = header
+        self.sync_interval = sync_interval
+        self._done = set()
+        self._fh = None
+        self._lock = threading.Lock()
+        self._last_sync = 0
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def is_consistent(self):
+        return self._load() is not None
+
+    def _load(self):
+        """Read what is done, or None if we can't trust it."""
+        done = set()
+        try:
+            with open(self.path) as fh:
+                if json.loads(fh.readline()) != self.header:
+                    return
+                for line in fh:
+                    if not line.endswith('\n'):
+                        break
+                    phase, key = json.loads(line)
+                    done.add((phase, key))
+        except (OSError, ValueError, TypeError):
+            return
+        return done
+
+    def open(self):
+        """Open for appending, loading what is there if it is consistent.
+
+        :returns: If we loaded an existing journal.
+
+        """
+
+        resumed = False
+
+        done = self._load()
+        if done is not None:
+            self._done = done
+            resumed = True
+            self._fh = open(self.path, 'a')
+
+        else:
+            self._fh = open(self.path, 'w')
+            self._fh.write(json.dumps(self.header, sort_keys=True) + '\n')
+            self.sync()
+
+        return resumed
+
+    def is_done(self, phase, key):
+        return (phase, key) in self._done
+
+    def record(self, phase, key):
+        with self._lock:
+            self._done.add((phase, key))
+            self._fh.write(json.dumps([phase, key]) + '\n')
+            # Into the OS every time so we survive the process dying, but
+            # only to disk every so often.
+            self._fh.flush()
+            if time.monotonic() - self._last_sync > self.sync_interval:
+                self._sync()
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._last_sync = time.monotonic()
+
+    def remove(self):
+        if self._fh:
+            self._fh.close()
+            self._fh = None
+        os.unlink(self.path)
@@ -1,6 +1,12 @@
+from concurrent import futures
+import collections
+import ctypes
+import errno
+import itertools
 import os
-import time
 import stat
+import threading
+import time
 
 from ..utils import format_bytes
 
@@ -9,92 +15,376 @@ def field(x):
     return f'{x:10s}'
 
 
+# Errors from the fancier copies which mean we should try the next method.
+_fallback_errnos = set((errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF, errno.ENOTSUP))
+
+
+def iter_data(fd, size):
+    """Yield ``(start, end)`` of every range of data (i.e. not holes) in a file.
+
+    If the filesystem can't tell us, the whole file is data.
+
+    """
+
+    pos = 0
+    while pos < size:
+
+        try:
+            start = os.lseek(fd, pos, os.SEEK_DATA)
+        except OSError as e:
+            # ENXIO means there is no more data.
+            if e.errno == errno.ENXIO:
+                return
+            if e.errno in (errno.EINVAL, errno.EOPNOTSUPP):
+                yield pos, size
+                return
+            raise
+        except AttributeError:
+            yield pos, size
+            return
+
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        if start >= end:
+            return
+
+        yield start, end
+        pos = end
+
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+_fallocate = None
+
+def punch_hole(fd, offset, length):
+    """Deallocate a range of a file; returns if the platform let us."""
+
+    global _fallocate
+
+    if _fallocate is None:
+        try:
+            _fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+        except AttributeError:
+            _fallocate = False
+        else:
+            _fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+            _fallocate.restype = ctypes.c_int
+
+    if not _fallocate:
+        return False
+
+    if _fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length):
+        err = ctypes.get_errno()
+        if err in (errno.EOPNOTSUPP, errno.ENOSYS):
+            return False
+        raise OSError(err, os.strerror(err))
+
+    return True
+
+
+def _get_umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+# What new files/directories get created with.
+UMASK = _get_umask()
+DEFAULT_FILE_MODE = 0o666 & ~UMASK
+DEFAULT_DIR_MODE = 0o777 & ~UMASK
+
+
+_meta_ops = dict(
+    chmod=lambda path, perms: os.chmod(path, perms), #, follow_symlinks=False)
+    chown=lambda path, uid, gid: os.chown(path, uid, gid, follow_symlinks=False),
+    utime=lambda path, ns: os.utime(path, ns=ns, follow_symlinks=False),
+)
+
+
 class Processor(object):
 
-    def __init__(self, dry_run=False, verbose=0):
+    # In order of preference; see _copy_fd.
+    copy_methods = ('copy_file_range', 'sendfile', 'readinto')
+
+    chunk_size = 1024 * 1024
+
+    def __init__(self, dry_run=False, verbose=0, batch_metadata=False):
         self.dry_run = dry_run
         self.verbose = verbose
+        self._local = threading.local()
+
+        # If set, chmod/chown/utime are queued until flush_metadata.
+        self.batch_metadata = batch_metadata
+        self._meta_queue = []
+        self._meta_lock = threading.Lock()
+
+        # How many of each operation we've issued.
+        self.counts = collections.Counter()
+        self._count_lock = threading.Lock()
+
+        # Directories whose entries we have changed (so their times have too).
+        self.dirty_dirs = set()
         
     def prename(self, src, dst):
+        self._touch('prename', src, dst)
         if self.verbose:
             print(field('prename'), f'{dst}\t{src}')
         if not self.dry_run:
             os.rename(src, dst)
 
     def rename(self, src, dst, original=None):
+        self._touch('rename', src, dst)
         if self.verbose:
             print(field('rename'), f'{dst}\t{original or src}\t{"via " if original else ""}{src if original else ""}')
         if not self.dry_run:
             os.rename(src, dst)
 
     def rmdir(self, path):
+        self._touch('rmdir', path)
         if self.verbose:
             print(field('rmdir'), path)
         if not self.dry_run:
             os.rmdir(path)
 
     def unlink(self, path, verbosity=1):
+        self._touch('unlink', path)
         if self.verbose >= verbosity:
             print(field('unlink'), path)
         if not self.dry_run:
             os.unlink(path)
 
     def mkdir(self, path):
+        self._touch('mkdir', path)
+        self.dirty_dirs.add(path)
         if self.verbose:
             print(field('mkdir'), path)
         if not self.dry_run:
             os.mkdir(path)
+
     def symlink(self, source, link_name):
+        self._touch('symlink', link_name)
         if self.verbose:
             print(field('symlink'), f'{link_name}\t{source}')
         if not self.dry_run:
             os.symlink(source, link_name)
 
-    def chmod(self, path, mode, verbosity=1):
+    def link(self, source, link_name):
+        self._touch('link', link_name)
+        if self.verbose:
+            print(field('link'), f'{link_name}\t{source}')
+        if not self.dry_run:
+            os.link(source, link_name)
+
+    def chmod(self, path, mode, verbosity=1, current=None):
         perms = stat.S_IMODE(mode)
+        # Nothing to do if we know it already has that mode.
+        if current is not None and stat.S_IMODE(current) == perms:
+            self.count('chmod-skipped')
+            return
+        self.count('chmod')
         if self.verbose >= verbosity:
             print(field('chmod'), f'{path}\t{stat.filemode(mode)}')
         if not self.dry_run:
-            os.chmod(path, perms) #, follow_symlinks=False)
+            self._apply(path, 'chmod', (perms, ))
 
     def chown(self, path, uid, gid, verbosity=1):
+        self.count('chown')
         if self.verbose >= verbosity:
             print(field('chown'), f'{uid}:{gid}\t{path}')
         if not self.dry_run:
-            os.chown(path, uid, gid, follow_symlinks=False)
+            self._apply(path, 'chown', (uid, gid))
 
-    def utime(self, path, atime, mtime, verbosity=1):
+    def utime(self, path, atime_ns, mtime_ns, verbosity=1):
+        self.count('utime')
         if self.verbose >= verbosity:
-            print(field('utime'), f'{atime}:{mtime} {path}')
+            print(field('utime'), f'{atime_ns}:{mtime_ns} {path}')
         if not self.dry_run:
-            os.utime(path, (atime, mtime), follow_symlinks=False)
-
-    def copy(self, src_path, dst_path):
-
+            self._apply(path, 'utime', ((atime_ns, mtime_ns), ))
+
+    def count(self, name, n=1):
+        with self._count_lock:
+            self.counts[name] += n
+
+    def _touch(self, name, *paths):
+        # Count the op, and remember which directories had entries change.
+        with self._count_lock:
+            self.counts[name] += 1
+            self.dirty_dirs.update(os.path.dirname(x) for x in paths)
+
+    def _apply(self, path, op, args):
+        if self.batch_metadata:
+            with self._meta_lock:
+                self._meta_queue.append((path, op, args))
+        else:
+            _meta_ops[op](path, *args)
+
+    def flush_metadata(self, threads=4, chunk_size=1024):
+        """Apply all of the metadata changes that have been queued up.
+
+        Only the last of each op is applied to each path, and they are applied
+        in path order (for locality) by a pool of threads in large chunks.
+
+        :returns: How many syscalls we made.
+
+        """
+
+        with self._meta_lock:
+            queue, self._meta_queue = self._meta_queue, []
+
+        # Ownership first, since chown can clear setuid bits that chmod sets,
+        # and times last.
+        by_path = {}
+        for path, op, args in queue:
+            by_path.setdefault(path, {})[op] = args
+        items = sorted(by_path.items())
+
+        def apply(chunk):
+            count = 0
+            for path, ops in chunk:
+                for op in ('chown', 'chmod', 'utime'):
+                    args = ops.get(op)
+                    if args is not None:
+                        _meta_ops[op](path, *args)
+                        count += 1
+            return count
+
+        chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+        if len(chunks) < 2:
+            return sum(map(apply, chunks))
+        with futures.ThreadPoolExecutor(threads) as executor:
+            return sum(executor.map(apply, chunks))
+
+    def copy(self, src_path, dst_path, new=True):
+
+        # Only new files change the directory.
+        if new:
+            self._touch('copy', dst_path)
+        else:
+            self.count('copy')
         if self.verbose:
             print(field('copy'), f'{dst_path}\t{src_path}')
         if self.dry_run:
             return
 
-        size = 128 * 1024 # ZFS block size.
-        copied = 0
         start = time.monotonic()
+        copied = 0
+        method = None
 
         with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
-            while True:
-                chunk = src.read(size)
-                if not chunk:
-                    break
-                dst.write(chunk)
-                copied += len(chunk)
+
+            src_fd = src.fileno()
+            dst_fd = dst.fileno()
+            size = os.fstat(src_fd).st_size
+
+            # Only the data is copied; truncating to the full size leaves holes
+            # everywhere else.
+            for offset, end in iter_data(src_fd, size):
+                method, n = self._copy_range(src_fd, dst_fd, offset, end - offset)
+                copied += n
+
+            os.ftruncate(dst_fd, size)
 
         if self.verbose > 1:
             duration = time.monotonic() - start
-            rate = copied / duration
-            print(field('copied'), f'{format_bytes(copied):>8s} in {duration:>6.2f}s at {format_bytes(rate):>8s}/s')
+            rate = copied / duration if duration else 0
+            print(field('copied'), f'{format_bytes(copied):>8s} in {duration:>6.2f}s at {format_bytes(rate):>8s}/s via {method}')
+
+    def _copy_range(self, src_fd, dst_fd, offset, length):
+        """Copy a range from src to the same place in dst, as cheaply as we can.
+
+        Each method picks up wherever the last one failed (or stopped short),
+        with a plain read/write to finish.
+
+        :returns: ``(method, copied)``, with the last method that was used.
+
+        """
+
+        copied = 0
+
+        for method in self.copy_methods:
+
+            try:
+
+                if method == 'copy_file_range':
+                    while copied < length:
+                        pos = offset + copied
+                        n = os.copy_file_range(src_fd, dst_fd, length - copied, pos, pos)
+                        if not n:
+                            break
+                        copied += n
+
+                elif method == 'sendfile':
+                    # This writes at the current position of dst.
+                    os.lseek(dst_fd, offset + copied, os.SEEK_SET)
+                    while copied < length:
+                        n = os.sendfile(dst_fd, src_fd, offset + copied, length - copied)
+                        if not n:
+                            break
+                        copied += n
+
+                elif method == 'readinto':
+                    buf = self._get_buffer()
+                    view = memoryview(buf)
+                    while copied < length:
+                        pos = offset + copied
+                        n = os.preadv(src_fd, [view[:length - copied]], pos)
+                        if not n:
+                            break
+                        done = 0
+                        while done < n:
+                            done += os.pwrite(dst_fd, view[done:n], pos + done)
+                        copied += n
+
+                else:
+                    raise ValueError(f"Unknown copy method {method!r}")
+
+            except (AttributeError, OSError) as e:
+                # Not supported by the platform or these filesystems (e.g.
+                # EXDEV on older kernels, or EINVAL/ENOSYS); try the next one.
+                if method == 'readinto' or isinstance(e, OSError) and e.errno not in _fallback_errnos:
+                    raise
+
+            if copied >= length:
+                return method, copied
+
+            # Some just stop (returning 0) on files they can't do, so the next
+            # one carries on; otherwise the truncate in copy would leave zeros
+            # where the rest should be.
+
+        raise ValueError(f"Could only copy {copied} of {length} bytes at {offset}.")
+
+    def _get_buffer(self):
+        try:
+            return self._local.buffer
+        except AttributeError:
+            buf = self._local.buffer = bytearray(self.chunk_size)
+            return buf
+
+    def _punch(self, fd, offset, length):
+        """Make a range of the file a hole (or at least zeros).
+
+        :returns: How many bytes we had to write.
+
+        """
+
+        if punch_hole(fd, offset, length):
+            return 0
+
+        # No hole punching here; settle for zeros where there aren't already.
+        written = 0
+        end = offset + length
+        while offset < end:
+            chunk = os.pread(fd, min(end - offset, self.chunk_size), offset)
+            if not chunk:
+                break
+            if chunk.count(0) != len(chunk):
+                os.pwrite(fd, bytes(len(chunk)), offset)
+                written += len(chunk)
+            offset += len(chunk)
+        return written
 
     def merge(self, src_path, dst_path):
 
+        self.count('merge')
         if self.verbose:
             print(field('merge'), f'{dst_path}\t{src_path}')
         if self.dry_run:
@@ -109,49 +399,158 @@ class Processor(object):
 
         with open(src_path, 'rb') as src, open(dst_path, 'r+b') as dst:
 
-            # Keep only writing changes until we've passed 3 blocks that
-            # are different.
-            while n_diff < 3:
-
-                pos = dst.tell()
+            src_fd = src.fileno()
+            dst_fd = dst.fileno()
+            src_size = os.fstat(src_fd).st_size
 
-                a = src.read(size)
-                b = dst.read(size)
+            pos = 0
+            for data_start, data_end in itertools.chain(iter_data(src_fd, src_size), [(src_size, src_size)]):
 
-                if len(a) != len(b):
-                    raise ValueError(f"Read len mismatch at {pos}: {len(a)} != {len(b)}")
+                # Holes in the source are holes in the destination.
+                if data_start > pos:
+                    written += self._punch(dst_fd, pos, data_start - pos)
 
-                # We're done.
-                if not a:
-                    break
+                pos = data_start
+                while pos < data_end:
 
-                read += len(a)
+                    # We gave up comparing; just finish it up normally.
+                    if n_diff >= 3:
+                        _, n = self._copy_range(src_fd, dst_fd, pos, data_end - pos)
+                        read += n
+                        written += n
+                        pos = data_end
+                        break
 
-                # The blocks match; don't do anything.
-                if a == b:
-                    continue
+                    # Keep only writing changes until we've passed 3 blocks that
+                    # are different.
+                    a = os.pread(src_fd, min(size, data_end - pos), pos)
+                    b = os.pread(dst_fd, len(a), pos)
 
-                dst.seek(pos)
-                dst.write(a)
+                    if len(a) != len(b):
+                        raise ValueError(f"Read len mismatch at {pos}: {len(a)} != {len(b)}")
 
-                written += len(a)
-                n_diff += 1
+                    # We're done.
+                    if not a:
+                        break
 
-            # We gave up comparing; just finish it up normally.
-            while a:
-                a = src.read(size)
-                if a:
-                    dst.write(a)
                     read += len(a)
-                    written += len(a)
+
+                    # The blocks don't match; write it.
+                    if a != b:
+                        os.pwrite(dst_fd, a, pos)
+                        written += len(a)
+                        n_diff += 1
+
+                    pos += len(a)
+
+                pos = max(pos, data_end)
 
         if self.verbose > 1:
             duration = time.monotonic() - start
-            rate = read / duration
+            rate = read / duration if duration else 0
             print(field('merged'), f'{format_bytes(written):>8s} of {format_bytes(read):>8s} in {duration:>6.2f}s at {format_bytes(rate):>8s}/s:', dst_path)
 
         return n_diff
 
+    def merge_blocks(self, src_path, dst_path, offsets, block_size):
+        """Copy only the blocks at the given offsets from src to dst.
 
+        The destination is assumed to otherwise match the source already; the
+        offsets come from comparing ZFS block pointers.
 
+        """
 
+        self.count('merge_blocks')
+        if self.verbose:
+            print(field('merge'), f'{dst_path}\t{src_path}\t{len(offsets)} blocks')
+        if self.dry_run:
+            return
+
+        start = time.monotonic()
+        written = 0
+
+        # Coalesce runs of neighbouring blocks into single reads/writes.
+        ranges = []
+        for offset in sorted(offsets):
+            if ranges and ranges[-1][1] == offset:
+                ranges[-1][1] = offset + block_size
+            else:
+                ranges.append([offset, offset + block_size])
+
+        with open(src_path, 'rb') as src, open(dst_path, 'r+b') as dst:
+            src_fd = src.fileno()
+            dst_fd = dst.fileno()
+            for offset, end in ranges:
+                while offset < end:
+                    chunk = os.pread(src_fd, min(end - offset, 16 * block_size), offset)
+                    if not chunk:
+                        break
+                    os.pwrite(dst_fd, chunk, offset)
+                    offset += len(chunk)
+                    written += len(chunk)
+
+        if self.verbose > 1:
+            duration = time.monotonic() - start
+            rate = written / duration if duration else 0
+            print(field('merged'), f'{format_bytes(written):>8s} in {len(ranges)} ranges in {duration:>6.2f}s at {format_bytes(rate):>8s}/s:', dst_path)
+
+        return len(offsets)
+
+
+if __name__ == '__main__':
+
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--size', action='append', type=int,
+        help="File sizes in kB; defaults to 4kB, 1MB and 256MB.")
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-m', '--metadata', type=int, metavar='COUNT',
+        help="Benchmark metadata ops on this many files instead of copies.")
+    parser.add_argument('dirs', nargs='+', help="Where to copy; e.g. a tmpfs and an ext4.")
+    args = parser.parse_args()
+
+    if args.metadata:
+        for dir_ in args.dirs:
+            with tempfile.TemporaryDirectory(dir=dir_) as tmp:
+                paths = [os.path.join(tmp, f'{i:08d}') for i in range(args.metadata)]
+                for path in paths:
+                    open(path, 'wb').close()
+                uid, gid = os.getuid(), os.getgid()
+                for batch in (False, True):
+                    proc = Processor(batch_metadata=batch)
+                    start = time.monotonic()
+                    for i, path in enumerate(paths):
+                        # A realistic mix, including some redundant ones.
+                        proc.chmod(path, 0o100644 if i % 2 else 0o100600, current=0o100644)
+                        proc.chown(path, uid, gid)
+                        proc.utime(path, i, i)
+                        proc.utime(path, i + 1, i + 1)
+                    if batch:
+                        proc.flush_metadata()
+                    duration = time.monotonic() - start
+                    print(f'{dir_} {"batched" if batch else "per-call":10s} {len(paths)} files in {duration:.2f}s ({len(paths) / duration:.0f} files/s)')
+        exit()
+
+    sizes = [x * 1024 for x in (args.size or (4, 1024, 256 * 1024))]
+
+    for dir_ in args.dirs:
+        for size in sizes:
+
+            src = tempfile.NamedTemporaryFile(dir=dir_)
+            src.write(os.urandom(min(size, 1024 * 1024)) * max(1, size // (1024 * 1024)))
+            src.flush()
+            dst_path = src.name + '.copy'
+
+            for method in Processor.copy_methods:
+                proc = Processor()
+                proc.copy_methods = (method, )
+                durations = []
+                for _ in range(args.repeat):
+                    start = time.monotonic()
+                    proc.copy(src.name, dst_path)
+                    durations.append(time.monotonic() - start)
+                    os.unlink(dst_path)
+                duration = min(durations)
+                print(f'{dir_} {format_bytes(size):>10s} {method:16s} {duration * 1000:8.2f}ms {format_bytes(size / duration):>10s}/s')
@@ -0,0 +1,69 @@
+from concurrent import futures
+import threading
+
+
+class Scheduler(object):
+    """Runs replay work with the biggest (by bytes) items first.
+
+    Work is given as ``(func, args, cost)``, where cost is roughly how many
+    bytes of I/O it will do. Anything costing at least ``min_io_cost`` goes to
+    the I/O pool, largest first, with at most ``max_bytes_in_flight`` between
+    them (any single item larger than that runs by itself). Everything else is
+    metadata-ish, and is run in batches by a separate pool so they don't wait
+    behind the copies.
+
+    """
+
+    def __init__(self, io_threads=4, meta_threads=4,
+        max_bytes_in_flight=1024 * 1024 * 1024,
+        min_io_cost=64 * 1024,
+        batch_size=256,
+    ):
+        self.io_threads = io_threads
+        self.meta_threads = meta_threads
+        self.max_bytes_in_flight = max_bytes_in_flight
+        self.min_io_cost = min_io_cost
+        self.batch_size = batch_size
+
+        self._cond = threading.Condition()
+        self._in_flight = 0
+
+    def run(self, work):
+
+        heavy = []
+        light = []
+        for item in work:
+            (heavy if item[2] >= self.min_io_cost else light).append(item)
+
+        heavy.sort(key=lambda x: x[2], reverse=True)
+
+        fs = []
+
+        with futures.ThreadPoolExecutor(self.io_threads) as io_pool, \
+             futures.ThreadPoolExecutor(self.meta_threads) as meta_pool:
+
+            for i in range(0, len(light), self.batch_size):
+                fs.append(meta_pool.submit(self._run_batch, light[i:i + self.batch_size]))
+
+            for func, args, cost in heavy:
+                cost = min(cost, self.max_bytes_in_flight)
+                with self._cond:
+                    self._cond.wait_for(lambda: self._in_flight + cost <= self.max_bytes_in_flight)
+                    self._in_flight += cost
+                fs.append(io_pool.submit(self._run_heavy, func, args, cost))
+
+            # Raise the first error (in submission order).
+            for f in fs:
+                f.result()
+
+    def _run_batch(self, batch):
+        for func, args, _ in batch:
+            func(*args)
+
+    def _run_heavy(self, func, args, cost):
+        try:
+            func(*args)
+        finally:
+            with self._cond:
+                self._in_flight -= cost
+                self._cond.notify_all()
@@ -4,7 +4,7 @@ import os
 import subprocess
 
 
-Snapshot = collections.namedtuple('Snapshot', ('name', 'volume', 'snapname', 'creation', 'root'))
+Snapshot = collections.namedtuple('Snapshot', ('name', 'volume', 'snapname', 'creation', 'root', 'guid'), defaults=(None, ))
 
 
 def get_snapshots(volume):
@@ -13,10 +13,10 @@ def get_snapshots(volume):
 
     snaproot = None
 
-    output = subprocess.check_output(['zfs', 'list', '-rd1', '-tall', '-Hp', '-otype,name,creation,mountpoint', volume])
+    output = subprocess.check_output(['zfs', 'list', '-rd1', '-tall', '-Hp', '-otype,name,creation,mountpoint,guid', volume])
     for line in output.decode().splitlines():
 
-        type_, name, creation_raw, mountpoint = line.strip().split('\t')
+        type_, name, creation_raw, mountpoint, guid = line.strip().split('\t')
 
         if type_ == 'filesystem':
             # If there is a child filesystem the above command will list it
@@ -31,7 +31,27 @@ def get_snapshots(volume):
 
         creation = dt.datetime.fromtimestamp(int(creation_raw))
 
-        res.append(Snapshot(name, volume, snapname, creation, os.path.join(snaproot, snapname)))
+        res.append(Snapshot(name, volume, snapname, creation, os.path.join(snaproot, snapname), int(guid)))
 
     return res
 
+
+_guids = {}
+
+def get_guid(name):
+    """Get the GUID of a dataset or snapshot, or None if we can't."""
+
+    try:
+        return _guids[name]
+    except KeyError:
+        pass
+
+    try:
+        output = subprocess.check_output(['zfs', 'get', '-Hp', '-o', 'value', 'guid', name], stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        guid = None
+    else:
+        guid = int(output.strip())
+
+    _guids[name] = guid
+    return guid
@@ -1,3 +1,16 @@
+import os
+
+
+# Where we keep anything derived from snapshots (which never change).
+CACHE_ROOT = os.environ.get('ZFSTOOLS_CACHE', '/mnt/tank/scratch/zfstools')
+
+
+def get_cache_dir(*parts):
+    path = os.path.join(CACHE_ROOT, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
 
 class cached_property(object):
 
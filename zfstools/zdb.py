@@ -1,34 +1,198 @@
-import subprocess
+from concurrent import futures
+import collections
 import os
+import queue
 import re
+import shlex
+import sqlite3
+import subprocess
+import threading
 
+from .snapshots import get_guid
+from .utils import get_cache_dir
 
-def get_block(dataset, obj):
+
+BlockMap = collections.namedtuple('BlockMap', 'top block_size blocks')
+
+_units = {b'': 1, b'K': 1 << 10, b'M': 1 << 20, b'G': 1 << 30}
+
+def _parse_size(raw):
+    m = re.match(rb'(\d+)([KMG]?)$', raw)
+    return int(m.group(1)) * _units[m.group(2)] if m else None
+
+
+def iter_blocks(dataset, objs, full=False):
+    """Yield ``(obj, block)`` with the top-level block pointer of each object.
+
+    All of the objects are dumped by a single ``zdb -ddddd``. Objects which
+    zdb doesn't give us a block for (e.g. they don't exist) are ``None``.
+
+    With ``full``, yield a :class:`BlockMap` instead, which also has the data
+    block size, and a dict mapping the offset of every L0 block to its
+    pointer (as the rest of the zdb line, so the birth txg is included).
+
+    """
 
     if '@' not in dataset:
         raise ValueError("Must be given snapshot.", dataset)
 
-    ret = None
+    remaining = set(objs)
+    obj = None
+    in_header = False
+    top = block_size = blocks = None
+
+    def finish():
+        if obj in remaining and top is not None:
+            remaining.discard(obj)
+            return obj, BlockMap(top, block_size, blocks) if full else top
 
-    proc = subprocess.Popen(['zdb', '-ddddd', dataset, str(obj)], stdout=subprocess.PIPE)
+    proc = subprocess.Popen(['zdb', '-ddddd', dataset] + [str(x) for x in sorted(remaining)], stdout=subprocess.PIPE)
     for line in proc.stdout:
 
         # Looks like:
-        #    0 L5      0:29ed4bcd7000:3000 20000L/1000P F=14 B=14229055/14229055
-        m = re.match(rb'\s*0\s+L\d\s+([0-9a-f]+:[0-9a-f]+:[0-9a-f]+)', line)
-        if not m:
+        #     Object  lvl   iblk   dblk  dsize  dnsize  lsize   %full  type
+        #      12345    3   128K   128K  ...
+        if in_header:
+            m = re.match(rb'\s*(\d+)\s+\d+\s+\S+\s+(\S+)\s', line)
+            if m:
+                obj = int(m.group(1))
+                block_size = _parse_size(m.group(2))
+                in_header = False
+            continue
+        if re.match(rb'\s*Object\s+lvl\s', line):
+            res = finish()
+            if res:
+                yield res
+            in_header = True
+            top = None
+            blocks = {}
+            continue
+
+        if obj not in remaining:
             continue
-        
-        ret = m.group(1)
-        proc.stdout.close()
-        break
+
+        # Looks like:
+        #    0 L5      0:29ed4bcd7000:3000 20000L/1000P F=14 B=14229055/14229055
+        if top is None:
+            m = re.match(rb'\s*0\s+L\d\s+([0-9a-f]+:[0-9a-f]+:[0-9a-f]+)', line)
+            if m:
+                top = m.group(1)
+                if not full:
+                    res = finish()
+                    yield res
+                    if not remaining:
+                        proc.stdout.close()
+                        break
+                    continue
+
+        if full:
+            # Looks like:
+            #    20000  L0 0:29ed4bcd7000:20000 20000L/20000P F=1 B=14229055/14229055
+            m = re.match(rb'\s*([0-9a-f]+)\s+L0\s+(.+?)\s*$', line)
+            if m:
+                blocks[int(m.group(1), 16)] = m.group(2)
+
+    else:
+        res = finish()
+        if res:
+            yield res
 
     proc.terminate()
     proc.kill()
+    proc.wait()
+
+    for obj in remaining:
+        yield obj, None
+
+
+def get_block_map(dataset, obj):
+    """Get the :class:`BlockMap` of a single object (or ``None``).
+
+    These can be huge, so they are not cached.
 
-    return ret
+    """
+    for _, res in iter_blocks(dataset, [obj], full=True):
+        return res
 
 
+class BlockService(object):
+    """Long-lived workers which look up block pointers in batches.
+
+    Requests from any thread are queued, and each worker gathers up whatever
+    is waiting (up to ``batch_size``) into one zdb run per snapshot. Results
+    are kept per snapshot, since they never change.
+
+    """
+
+    def __init__(self, workers=4, batch_size=256, linger=0.01):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.linger = linger
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._cache = {} # dataset -> {obj: future}
+
+    def _start(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, dataset, obj):
+        with self._lock:
+            by_obj = self._cache.setdefault(dataset, {})
+            future = by_obj.get(obj)
+            if future is None:
+                future = by_obj[obj] = futures.Future()
+                self._queue.put((dataset, obj, future))
+                self._start()
+        return future
+
+    def get_block(self, dataset, obj):
+        return self.submit(dataset, obj).result()
+
+    def get_blocks(self, requests):
+        """Get the blocks for many ``(dataset, obj)``; returns a dict."""
+        submitted = [((dataset, obj), self.submit(dataset, obj)) for dataset, obj in requests]
+        return {key: future.result() for key, future in submitted}
+
+    def _work(self):
+        while True:
+
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=self.linger))
+                except queue.Empty:
+                    break
+
+            by_dataset = {}
+            for dataset, obj, future in batch:
+                by_dataset.setdefault(dataset, {})[obj] = future
+
+            for dataset, by_obj in by_dataset.items():
+                try:
+                    for obj, block in iter_blocks(dataset, by_obj):
+                        by_obj.pop(obj).set_result(block)
+                except Exception as e:
+                    for future in by_obj.values():
+                        future.set_exception(e)
+
+
+_block_service = BlockService()
+
+def get_block(dataset, obj):
+    return _block_service.get_block(dataset, obj)
+
+def get_blocks(requests):
+    return _block_service.get_blocks(requests)
+
+
+
+# The helper we talk to for generation numbers; ZFSTOOLS_ZGEN may replace it
+# with a command line, e.g. to use fakezgen.py.
+ZGEN_CMD = shlex.split(os.environ.get('ZFSTOOLS_ZGEN', '')) or [os.path.abspath(os.path.join(__file__, '..', 'zgen'))]
 
 _gen_proc = None
 
@@ -36,28 +200,20 @@ _gen_proc = None
 class ZDBError(EnvironmentError):
     pass
 
-def get_gen(dataset, obj):
 
-    global _gen_proc
+def _start_zgen():
+    return subprocess.Popen(ZGEN_CMD,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        #universal_newlines=True,
+    )
 
-    if _gen_proc is None:
 
-        _gen_proc = subprocess.Popen([os.path.abspath(os.path.join(__file__, '..', 'zgen'))],
-            bufsize=1,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            #universal_newlines=True,
-        )
-
-    # print('<<<', dataset, obj)
-    _gen_proc.stdin.write(f'{dataset} {obj:d}\n'.encode())
-    _gen_proc.stdin.flush()
-    raw = _gen_proc.stdout.readline().decode().rstrip()
-    # print(">>>", repr(raw))
+def _parse_gen(dataset, obj, raw):
 
     res = raw.split()
 
-    if res[2] == 'ERROR':
+    if len(res) > 2 and res[2] == 'ERROR':
         errno = int(res[3])
         error = ' '.join(res[4:])
         if errno == 2:
@@ -77,21 +233,226 @@ def get_gen(dataset, obj):
     return gen
 
 
+class _GenCache(object):
+    """Generation numbers we've already looked up, by snapshot GUID.
 
-if __name__ == '__main__':
+    Snapshots never change, so neither do the generations within them. We
+    store ``NULL`` for objects which don't exist.
 
-    import time
+    """
+
+    def __init__(self):
+        self._db = None
+        self._lock = threading.Lock()
+
+    @property
+    def db(self):
+        if self._db is None:
+            path = os.path.join(get_cache_dir(), 'gens.sqlite')
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('''CREATE TABLE IF NOT EXISTS gens (
+                guid INTEGER NOT NULL,
+                obj INTEGER NOT NULL,
+                gen INTEGER,
+                PRIMARY KEY (guid, obj)
+            ) WITHOUT ROWID''')
+        return self._db
+
+    def get(self, guid, obj, default=None):
+        with self._lock:
+            row = self.db.execute('SELECT gen FROM gens WHERE guid = ? AND obj = ?', (guid, obj)).fetchone()
+        return row[0] if row else default
+
+    def get_all(self, guid):
+        with self._lock:
+            return dict(self.db.execute('SELECT obj, gen FROM gens WHERE guid = ?', (guid, )))
+
+    def set_many(self, guid, items):
+        with self._lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO gens (guid, obj, gen) VALUES (?, ?, ?)',
+                ((guid, obj, gen) for obj, gen in items))
+
+
+_gen_cache = _GenCache()
+_missing = object()
+
+
+def get_gen(dataset, obj):
+
+    guid = get_guid(dataset)
+    if guid:
+        gen = _gen_cache.get(guid, obj, _missing)
+        if gen is not _missing:
+            return gen
+
+    gen = _get_gen(dataset, obj)
+
+    if guid:
+        _gen_cache.set_many(guid, [(obj, gen)])
+
+    return gen
+
+
+def _get_gen(dataset, obj):
+
+    global _gen_proc
+
+    if _gen_proc is None:
+        _gen_proc = _start_zgen()
+
+    # print('<<<', dataset, obj)
+    _gen_proc.stdin.write(f'{dataset} {obj:d}\n'.encode())
+    _gen_proc.stdin.flush()
+    raw = _gen_proc.stdout.readline().decode().rstrip()
+    # print(">>>", repr(raw))
+
+    return _parse_gen(dataset, obj, raw)
+
+
+def iter_gens(dataset, objs, window=4096):
+    """Yield ``(obj, gen)`` for every object in one dataset.
+
+    Requests are streamed to a dedicated zgen by a writer thread while we read
+    the responses as they come back, with at most ``window`` in flight.
+
+    """
+
+    proc = _start_zgen()
+    slots = threading.Semaphore(window)
+    sent = queue.Queue()
+    stop = threading.Event()
+    errors = []
+
+    def write():
+        try:
+            for obj in objs:
+                # Don't leave anything sitting in our buffer when we have to
+                # wait for responses to it.
+                if not slots.acquire(blocking=False):
+                    proc.stdin.flush()
+                    while not slots.acquire(timeout=0.1):
+                        if stop.is_set():
+                            return
+                if stop.is_set():
+                    return
+                sent.put(obj)
+                proc.stdin.write(f'{dataset} {obj:d}\n'.encode())
+            proc.stdin.flush()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            sent.put(None)
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+
+    try:
+        while True:
+            obj = sent.get()
+            if obj is None:
+                break
+            raw = proc.stdout.readline().decode().rstrip()
+            slots.release()
+            yield obj, _parse_gen(dataset, obj, raw)
+    finally:
+        # We may be here early (closed, or an error), with the writer waiting
+        # for slots or blocked writing to zgen; wake it up and kill zgen so
+        # that it can't still be stuck by the time we join it.
+        stop.set()
+        slots.release(window)
+        proc.kill()
+        proc.wait()
+        writer.join()
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+
+    if errors:
+        raise errors[0]
+
+
+def get_gens(requests, window=4096):
+    """Get generation numbers for many ``(dataset, obj)`` at once.
+
+    Each dataset gets its own zgen, and they all run in parallel.
+
+    :returns: Dict mapping ``(dataset, obj)`` to the generation (or ``None``
+        if the object does not exist).
+
+    """
+
+    by_dataset = {}
+    for dataset, obj in requests:
+        by_dataset.setdefault(dataset, []).append(obj)
+
+    res = {}
+
+    def run(dataset, objs):
+
+        guid = get_guid(dataset)
+        if guid:
+            cached = _gen_cache.get_all(guid)
+            misses = []
+            for obj in objs:
+                gen = cached.get(obj, _missing)
+                if gen is _missing:
+                    misses.append(obj)
+                else:
+                    res[(dataset, obj)] = gen
+            objs = misses
+
+        if not objs:
+            return
+
+        found = []
+        for obj, gen in iter_gens(dataset, objs, window):
+            res[(dataset, obj)] = gen
+            found.append((obj, gen))
+
+        if guid:
+            _gen_cache.set_many(guid, found)
 
-    from .index import Index
+    if len(by_dataset) < 2:
+        for dataset, objs in by_dataset.items():
+            run(dataset, objs)
+        return res
 
-    idx = Index.get('/mnt/tank/heap/sitg/work/.zfs/snapshot/2018-08-01T02:00:01-04:00')
-    print('starting...')
-    start = time.time()
+    with futures.ThreadPoolExecutor(len(by_dataset)) as executor:
+        for f in [executor.submit(run, dataset, objs) for dataset, objs in by_dataset.items()]:
+            f.result()
 
-    for n in idx.nodes:
-        gen = get_gen('tank/heap/sitg/work@2018-08-01T02:00:01-04:00', n.stat.st_ino)
-        # print(n.stat.st_ino, gen)
+    return res
 
-    dur = time.time() - start
-    print(len(idx.nodes), dur)
 
+
+if __name__ == '__main__':
+
+    import argparse
+    import sys
+    import time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=100000)
+    parser.add_argument('-w', '--window', type=int, default=4096)
+    parser.add_argument('-f', '--fake', action='store_true', help="Use fakezgen.py instead of zgen.")
+    parser.add_argument('-s', '--serial', action='store_true', help="Also time one at a time.")
+    parser.add_argument('datasets', nargs='+')
+    args = parser.parse_args()
+
+    if args.fake:
+        ZGEN_CMD = [sys.executable, os.path.abspath(os.path.join(__file__, '..', 'fakezgen.py'))]
+
+    requests = [(ds, obj) for ds in args.datasets for obj in range(1, args.count + 1)]
+
+    if args.serial:
+        start = time.monotonic()
+        for ds, obj in requests:
+            get_gen(ds, obj)
+        dur = time.monotonic() - start
+        print(f'serial:    {len(requests)} in {dur:.2f}s ({len(requests) / dur:.0f}/s)')
+
+    start = time.monotonic()
+    gens = get_gens(requests, window=args.window)
+    dur = time.monotonic() - start
+    print(f'pipelined: {len(gens)} in {dur:.2f}s ({len(gens) / dur:.0f}/s)')